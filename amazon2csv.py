@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import logging
 import click
 import amazonscraper
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option(
     '--keywords', '-k',
     type=str,
@@ -40,18 +41,364 @@ https://www.amazon.com/s/field-keywords=python%2Bscraping',
     help='Save the html page to the current folder with the specified name',
     default="",
 )
-def main(keywords, url, csvseparator, maxproductnb, outputhtml):
-    """ Search for products on Amazon, and extract it as CSV """
-    products = amazonscraper.search(
+@click.option(
+    '--keywords-file', '-f',
+    type=click.File('r'),
+    help='a file with one search (keywords) per line, \
+the searches are run concurrently',
+    default=None,
+)
+@click.option(
+    '--concurrency', '-c',
+    type=int,
+    help='Number of searches run in parallel with --keywords-file (ex : 4)',
+    default=4,
+)
+@click.option(
+    '--parser', '-p',
+    type=click.Choice(['html.parser', 'lxml', 'html5lib']),
+    help='HTML parser (lxml is the fastest, if installed)',
+    default='html.parser',
+)
+@click.option(
+    '--format', 'output_format',
+    type=click.Choice(['csv', 'jsonl', 'parquet']),
+    help='Output format (from the extension of --output by default, else \
+csv). parquet requires pyarrow and --output',
+    default=None,
+)
+@click.option(
+    '--output',
+    type=str,
+    help='Output file (standard output by default), compressed if it ends \
+with .gz or .zst (requires zstandard). It is only created once complete',
+    default="",
+)
+@click.option(
+    '--verbose', '-v',
+    count=True,
+    help='Log the progress on the standard error (-vv for more details)',
+)
+@click.option(
+    '--layouts',
+    type=click.Path(exists=True, dir_okay=False),
+    help='JSON (or YAML) file of result page layouts, replacing or \
+completing the built-in ones',
+    default=None,
+)
+@click.option(
+    '--diff',
+    type=click.Path(dir_okay=False),
+    help='SQLite file of the previous results of the searches : only the \
+products that changed since then are written (new, dropped, or with another \
+rank, price, rating or number of reviews), and the file is updated',
+    default=None,
+)
+@click.pass_context
+def main(ctx, keywords, url, csvseparator, maxproductnb, outputhtml,
+         keywords_file, concurrency, parser, output_format, output, verbose,
+         layouts, diff):
+    """ Search for products on Amazon, and extract it as CSV (or JSON
+    Lines, or Parquet) """
+    if verbose:
+        logging.basicConfig(
+            level=logging.INFO if verbose == 1 else logging.DEBUG,
+            format='%(asctime)s %(levelname)s %(message)s')
+    if layouts is not None:
+        try:
+            amazonscraper.load_layouts(layouts)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--layouts')
+    # the subcommands running processes load the layouts in each of them
+    ctx.obj = {'layouts': layouts}
+    if ctx.invoked_subcommand is not None:
+        return
+    if output_format is None and output.endswith('.parquet'):
+        output_format = 'parquet'
+    if output_format == 'parquet' and output == "":
+        raise click.UsageError('--output is required with --format parquet')
+    if output_format == 'parquet' and diff is not None:
+        raise click.UsageError('--diff can not be used with --format parquet')
+
+    if keywords_file is not None:
+        keywords_list = [line.strip() for line in keywords_file
+                         if line.strip()]
+        if output_format == 'parquet':
+            _search_many_to_parquet(keywords_list, output, maxproductnb,
+                                    concurrency, parser)
+        elif diff is not None:
+            _search_many_diff_to_file(keywords_list, diff, output,
+                                      output_format, csvseparator,
+                                      maxproductnb, concurrency, parser)
+        else:
+            _search_many_to_file(keywords_list, output, output_format,
+                                 csvseparator, maxproductnb, concurrency,
+                                 parser)
+        return
+
+    if output_format == 'parquet':
+        products = amazonscraper.search(keywords=keywords,
+                                        search_url=url,
+                                        max_product_nb=maxproductnb,
+                                        parser=parser)
+        products.to_parquet(output)
+        if (outputhtml != ""):
+            with open(outputhtml, "w") as f:
+                f.write(products.last_html_page)
+        return
+
+    if diff is not None:
+        from amazonscraper.snapshot import DIFF_COLUMNS
+        products = amazonscraper.search(
+            keywords=keywords,
+            search_url=url,
+            max_product_nb=maxproductnb,
+            parser=parser,
+            diff_against=amazonscraper.SnapshotStore(diff))
+        with _open_writer(output, output_format, csvseparator,
+                          DIFF_COLUMNS) as writer:
+            writer.write_products(products)
+        if (outputhtml != ""):
+            with open(outputhtml, "w") as f:
+                f.write(products.last_html_page)
+        return
+
+    amz = amazonscraper.Client(parser=parser)
+    products = amazonscraper.iter_search(
                                     keywords=keywords,
                                     search_url=url,
-                                    max_product_nb=maxproductnb)
+                                    max_product_nb=maxproductnb,
+                                    client=amz)
 
-    print(products.csv(separator=csvseparator))
+    # The rows are written as soon as the products of a page are extracted
+    with _open_writer(output, output_format, csvseparator) as writer:
+        for product in products:
+            writer.write(product)
+            if output == "":
+                writer.flush()
 
     if (outputhtml != ""):
         with open(outputhtml, "w") as f:
-            f.write(products.last_html_page)
+            f.write(amz.html_pages.last)
+
+
+@main.command()
+@click.argument(
+    'paths',
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True),
+)
+@click.option(
+    '--url', '-u',
+    type=str,
+    help='Amazon domain of the pages, to build the product URLs \
+(ex : https://www.amazon.fr/)',
+    default=amazonscraper._BASE_URL,
+)
+@click.option(
+    '--csvseparator', '-s',
+    type=str,
+    help='CSV separator (ex : ;)',
+    default=",",
+)
+@click.option(
+    '--parser', '-p',
+    type=click.Choice(['html.parser', 'lxml', 'html5lib']),
+    help='HTML parser (lxml is the fastest, if installed)',
+    default='html.parser',
+)
+@click.option(
+    '--jobs', '-j',
+    type=int,
+    help='Number of processes (default : number of CPUs)',
+    default=None,
+)
+@click.option(
+    '--chunksize',
+    type=int,
+    help='Number of files sent at once to a process',
+    default=None,
+)
+@click.pass_obj
+def reparse(obj, paths, url, csvseparator, parser, jobs, chunksize):
+    """ Extract again the products of saved result pages (HTML files, or
+    directories of .html and .html.gz files), as CSV """
+    with _open_writer("", "csv", csvseparator, ['file']) as writer:
+        for path, products in amazonscraper.reparse(paths,
+                                                    base_url=url,
+                                                    parser=parser,
+                                                    processes=jobs,
+                                                    chunksize=chunksize,
+                                                    layouts=obj['layouts']):
+            writer.write_products(products, file=path)
+
+
+@main.command()
+@click.argument('queue_file', type=click.Path(dir_okay=False))
+@click.option(
+    '--keywords', '-k',
+    type=str,
+    multiple=True,
+    help='keywords of a search (may be repeated)',
+)
+@click.option(
+    '--url', '-u',
+    type=str,
+    multiple=True,
+    help='an Amazon result page URL (may be repeated)',
+)
+@click.option(
+    '--keywords-file', '-f',
+    type=click.File('r'),
+    help='a file with one search (keywords) per line',
+    default=None,
+)
+@click.option(
+    '--maxproductnb', '-m',
+    type=int,
+    help='Maximum number of products per search (ex : 100)',
+    default="100",
+)
+def enqueue(queue_file, keywords, url, keywords_file, maxproductnb):
+    """ Add searches to the job queue QUEUE_FILE (SQLite), to be run by the
+    workers of the `work` command """
+    keywords_list = list(keywords)
+    if keywords_file is not None:
+        keywords_list.extend(line.strip() for line in keywords_file
+                             if line.strip())
+    queue = amazonscraper.CrawlQueue(queue_file)
+    for search in keywords_list:
+        queue.put(keywords=search, max_product_nb=maxproductnb)
+    for search_url in url:
+        queue.put(search_url=search_url, max_product_nb=maxproductnb)
+
+
+@main.command()
+@click.argument('queue_file', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--workers', '-w',
+    type=int,
+    help='Number of worker processes (default : number of CPUs)',
+    default=None,
+)
+@click.option(
+    '--max-requests-per-host',
+    type=int,
+    help='Maximum number of pages of a same Amazon host downloaded at the \
+same time, by all the workers of the queue',
+    default=2,
+)
+@click.option(
+    '--lease-time',
+    type=int,
+    help='Seconds after which the page of a crashed worker is given to \
+another worker',
+    default=300,
+)
+@click.option(
+    '--parser', '-p',
+    type=click.Choice(['html.parser', 'lxml', 'html5lib']),
+    help='HTML parser (lxml is the fastest, if installed)',
+    default='html.parser',
+)
+@click.pass_obj
+def work(obj, queue_file, workers, max_requests_per_host, lease_time,
+         parser):
+    """ Run workers on the job queue QUEUE_FILE, until all its searches are
+    done (other workers may run on the same machine, not through a network
+    file system) """
+    stats = amazonscraper.run_workers(
+        queue_file, processes=workers, lease_time=lease_time,
+        max_requests_per_host=max_requests_per_host, parser=parser,
+        layouts=obj['layouts'])
+    counts = amazonscraper.CrawlQueue(queue_file).counts()
+    click.echo('{} pages done, {} failed ({} requests)'.format(
+        counts.get('done', 0), counts.get('failed', 0), stats['requests']),
+        err=True)
+
+
+@main.command()
+@click.argument('queue_file', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--csvseparator', '-s',
+    type=str,
+    help='CSV separator (ex : ;)',
+    default=",",
+)
+def results(queue_file, csvseparator):
+    """ Write the products found by the workers of the job queue QUEUE_FILE
+    as CSV, prefixed with their search """
+    with _open_writer("", "csv", csvseparator, ['search']) as writer:
+        for search, product_dict in amazonscraper.CrawlQueue(
+                queue_file).results():
+            writer.write(amazonscraper.Product(product_dict), search=search)
+
+
+def _open_writer(output, output_format, separator, prefix_columns=()):
+    """ Returns the `ProductWriter` of the --output file (of the standard
+    output if empty) """
+    if output_format is None and output == "":
+        output_format = 'csv'
+    return amazonscraper.ProductWriter(
+        output or None, output_format=output_format, separator=separator,
+        prefix_columns=prefix_columns)
+
+
+def _search_many_to_file(keywords_list, output, output_format, separator,
+                         max_product_nb, concurrency, parser):
+    """ Run the searches concurrently and write the products as they are
+    found, prefixed with their keywords """
+    with _open_writer(output, output_format, separator,
+                      ['keywords']) as writer:
+        for keywords, product in amazonscraper.iter_search_many(
+                keywords_list,
+                concurrency=concurrency,
+                max_product_nb=max_product_nb,
+                parser=parser):
+            writer.write(product, keywords=keywords)
+            if output == "":
+                writer.flush()
+
+
+def _search_many_diff_to_file(keywords_list, snapshot_file, output,
+                              output_format, separator, max_product_nb,
+                              concurrency, parser):
+    """ Run the searches concurrently and write the products that changed
+    since their previous results in the `snapshot_file`, prefixed with their
+    keywords, as the searches complete """
+    from amazonscraper.snapshot import DIFF_COLUMNS
+    with _open_writer(output, output_format, separator,
+                      ['keywords'] + DIFF_COLUMNS) as writer:
+        for keywords, products in amazonscraper.search_many(
+                keywords_list,
+                concurrency=concurrency,
+                max_product_nb=max_product_nb,
+                parser=parser,
+                diff_against=amazonscraper.SnapshotStore(snapshot_file)):
+            writer.write_products(products, keywords=keywords)
+            if output == "":
+                writer.flush()
+
+
+def _search_many_to_parquet(keywords_list, file_name, max_product_nb,
+                            concurrency, parser):
+    """ Run the searches concurrently and write all the products in a Parquet
+    file, with a column of their keywords """
+    import pyarrow
+    import pyarrow.parquet
+
+    tables = []
+    for keywords, products in amazonscraper.search_many(
+            keywords_list,
+            concurrency=concurrency,
+            max_product_nb=max_product_nb,
+            parser=parser):
+        table = products.to_arrow()
+        tables.append(table.add_column(
+            0, 'keywords',
+            pyarrow.array([keywords] * len(products), pyarrow.string())))
+    pyarrow.parquet.write_table(pyarrow.concat_tables(tables), file_name)
 
 
 if __name__ == "__main__":
@@ -2,13 +2,63 @@
 """ This package allows you to search for products on Amazon and extract some
 useful information (title, ratings, number of reviews).
 """
+from array import array
 from builtins import object
-import csv
-from amazonscraper.client import Client
+from collections import Counter
+import importlib
+import io
+from amazonscraper.defaults import _BASE_URL, _DEFAULT_ENRICH_CONCURRENCY
 
 
 __version__ = '0.1.2'  # Should be the same in setup.py
 
+# Attributes imported on their first use, with their module : importing the
+# package does not import requests, BeautifulSoup or aiohttp (ex : for
+# `amazon2csv --version`)
+_LAZY_ATTRIBUTES = {
+    'Client': 'amazonscraper.client',
+    'HostSemaphores': 'amazonscraper.client',
+    'new_session': 'amazonscraper.client',
+    'load_layouts': 'amazonscraper.client',
+    'AsyncClient': 'amazonscraper.async_client',
+    'extract_files': 'amazonscraper.archive',
+    'extract_html': 'amazonscraper.archive',
+    'ResponseCache': 'amazonscraper.cache',
+    'CrawlCheckpoint': 'amazonscraper.checkpoint',
+    'CrawlQueue': 'amazonscraper.jobqueue',
+    'ProductWriter': 'amazonscraper.writers',
+    'SnapshotStore': 'amazonscraper.snapshot',
+    'run_workers': 'amazonscraper.jobqueue',
+    'HostRateLimiter': 'amazonscraper.ratelimit',
+}
+_SUBMODULES = frozenset(['archive', 'async_client', 'cache', 'checkpoint',
+                         'client', 'database', 'defaults', 'html_pages',
+                         'jobqueue', 'ratelimit', 'snapshot', 'writers'])
+
+
+def __getattr__(name):
+    """ Import the lazy attributes and the submodules on their first use
+    >>> __getattr__('HostRateLimiter').__name__
+    'HostRateLimiter'
+    >>> __getattr__('Unknown')
+    Traceback (most recent call last):
+    ...
+    AttributeError: module 'amazonscraper' has no attribute 'Unknown'
+    """
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(__name__ + '.' + name)
+    else:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | _SUBMODULES)
+
 
 class Products(object):
     """Class of the products"""
@@ -16,6 +66,7 @@ class Products(object):
         self.products = []
         self.last_html_page = ""  # HTML content of the last scraped page
         self.html_pages = []
+        self.stats = Counter()  # Statistics counters of the client
         for product_dict in product_dict_list:
             self._add_product(product_dict)
 
@@ -45,55 +96,509 @@ class Products(object):
         (ex : products[1]) """
         return self.products[key]
 
-    def csv(self, file_name, separator=","):
-        """ Returns a CSV string with the product info
+    def csv(self, file_name=None, separator=","):
+        """ Write the products to the CSV file `file_name` (compressed if it
+        ends with .gz or .zst, see `ProductWriter`), or returns the CSV
+        string if `file_name` is None. The columns are the fields of
+        `Product`, then the extra fields of the products (ex : brand)
         >>> p = Products([{'title':'Book title', 'rating': '4.2',\
 'review_nb': '15', 'url':'http://www.amazon.com/book', 'asin':'A12345'}])
-        >>> p.csv()
-        'Product title,Rating,Number of customer reviews,\
-Product URL,Image URL,ASIN\\n"Book title",4.2,15,http://www.amazon.com/book,,A12345'
-
         >>> print(p.csv(separator=";"))
-        Product title;Rating;Number of customer reviews;Product URL;Image URL;ASIN
-        "Book title";4,2;15;http://www.amazon.com/book;;A12345
+        title;rating;review_nb;img;url;asin;prices_per_unit;units;prices_main
+        Book title;4.2;15;;http://www.amazon.com/book;A12345;;;
+        <BLANKLINE>
+        >>> Products().csv().split(",")[:3]
+        ['title', 'rating', 'review_nb']
+        """
+        from amazonscraper.writers import ProductWriter
+        extra_columns = {}
+        for product in self.products:
+            if product.extra:
+                extra_columns.update(dict.fromkeys(product.extra))
+        columns = list(Product._FIELDS) + list(extra_columns)
 
-        >>> p2 = Products()
-        >>> p2.csv()
-        'Product title,Rating,Number of customer reviews,Product URL,Image URL,ASIN'
+        if file_name is None:
+            csv_file = io.StringIO()
+            ProductWriter(csv_file, "csv", separator, columns).write_products(
+                self.products)
+            return csv_file.getvalue()
+        with ProductWriter(file_name, "csv", separator, columns) as writer:
+            writer.write_products(self.products)
+
+    def to_columns(self):
+        """ Returns a dict of typed columns : `array('d')` of floats for the
+        numeric fields (NaN if missing, ready for `numpy.asarray`), lists of
+        strings for the others
+        >>> p = Products([{'title':'Book title', 'rating': 4.2,\
+'review_nb': 15, 'asin':'A12345'}, {'title':'Book 2', 'review_nb': 3}])
+        >>> columns = p.to_columns()
+        >>> columns['asin'], columns['units']
+        (['A12345', ''], ['', ''])
+        >>> columns['review_nb']
+        array('d', [15.0, 3.0])
+        >>> list(columns) == list(Product._FIELDS)
+        True
         """
+        columns = {}
+        for field in Product._FIELDS:
+            values = [getattr(product, field) for product in self.products]
+            if field in _FLOAT_FIELDS:
+                columns[field] = array('d', values)
+            else:
+                # a missing unit is NaN
+                columns[field] = [value if isinstance(value, str) else ""
+                                  for value in values]
+        return columns
+
+    def to_arrow(self):
+        """ Returns the products as a `pyarrow.Table` (requires pyarrow) """
+        pa = _import_pyarrow()
+        columns = self.to_columns()
+        return pa.table({
+            field: pa.array(values, type=pa.float64()
+                            if field in _FLOAT_FIELDS else pa.string())
+            for field, values in columns.items()})
+
+    def to_parquet(self, file_name):
+        """ Write the products to the Parquet file `file_name` (requires
+        pyarrow) """
+        _import_pyarrow()
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(self.to_arrow(), file_name)
+
 
-        if not self.products:
-            return
+# Fields exported as float columns (with NaN for the missing values)
+_FLOAT_FIELDS = frozenset(
+    ['rating', 'review_nb', 'prices_per_unit', 'prices_main'])
 
-        with open(file_name, 'w') as csvfile:
-            writer = csv.writer(csvfile, delimiter=separator)
 
-            header = list(self.products[0].product.keys())
-            writer.writerow(header)
+def _import_pyarrow():
+    """ Returns the pyarrow module, which is an optional dependency """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Arrow and Parquet exports require pyarrow \
+(pip install pyarrow)')
+    return pyarrow
 
-            for product in self.products:
-                writer.writerow(list(product.product.values()))
 
 class Product(object):
-    """Class of a product"""
+    """Class of a product, with typed fields : `rating` and the prices are
+    floats, `review_nb` an int (NaN if missing), the other fields strings.
+    The fields that are not known are kept in the `extra` dict
+    >>> p = Product({'title': 'Book title', 'rating': '4.2',\
+'review_nb': '1,015', 'prices_main': '12.5, 9.99', 'brand': 'Me'})
+    >>> print(p.title, p.rating, p.review_nb, p.prices_main, p.brand)
+    Book title 4.2 1015 12.5 Me
+    >>> p.units, p.asin
+    (nan, '')
+    >>> p.product['review_nb'], p.product['brand']
+    (1015, 'Me')
+    """
+    __slots__ = ('title', 'rating', 'review_nb', 'img', 'url', 'asin',
+                 'prices_per_unit', 'units', 'prices_main', 'extra')
+    # Fields of a product, in the order of the extraction from the page
+    _FIELDS = __slots__[:-1]
+    _FIELD_SET = frozenset(_FIELDS)
+
     def __init__(self, product_dict={}):
-        self.product = product_dict
+        self.title = product_dict.get('title', "")
+        self.rating = _to_float(product_dict.get('rating'))
+        self.review_nb = _to_int(product_dict.get('review_nb'))
+        self.img = product_dict.get('img', "")
+        self.url = product_dict.get('url', "")
+        self.asin = product_dict.get('asin', "")
+        self.prices_per_unit = _to_float(product_dict.get('prices_per_unit'))
+        self.units = product_dict.get('units', float('nan'))
+        self.prices_main = _to_float(product_dict.get('prices_main'))
+        self.extra = None
+        if not self._FIELD_SET.issuperset(product_dict):
+            self.extra = {key: value for key, value in product_dict.items()
+                          if key not in self._FIELDS}
+
+    @property
+    def product(self):
+        """ Dictionary of the fields of the product : a read-only snapshot,
+        built at each access (changing it does not change the product)
+        >>> p = Product({'title': 'Book title'})
+        >>> p.product['title'] = 'Other title'
+        >>> p.product['title']
+        'Book title'
+        """
+        product_dict = {field: getattr(self, field) for field in self._FIELDS}
+        if self.extra:
+            product_dict.update(self.extra)
+        return product_dict
 
     def __getattr__(self, attr):
-        """ Method to access a dictionnary key as an attribute
-        (ex : product.title) """
-        return self.product.get(attr, "")
+        """ Method to access the extra fields as attributes, returns an empty
+        string if unknown (ex : product.brand) """
+        if attr.startswith('__') or attr in Product.__slots__:
+            raise AttributeError(attr)
+        if self.extra is None:
+            return ""
+        return self.extra.get(attr, "")
+
+
+def _to_float(value):
+    """ Returns the value as a float, NaN if missing or not a number. For a
+    comma-separated list of prices, the first one shown is returned
+    >>> _to_float('4.5'), _to_float(None), _to_float(''), _to_float(2)
+    (4.5, nan, nan, 2.0)
+    >>> _to_float('12.5, 9.99')
+    12.5
+    """
+    if value.__class__ is float:
+        return value
+    try:
+        if isinstance(value, str) and ', ' in value:
+            value = value.split(', ', 1)[0]
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def _to_int(value):
+    """ Returns the value as an int, NaN if missing or not a number
+    >>> _to_int('1,015'), _to_int(12), _to_int(''), _to_int(float('nan'))
+    (1015, 12, nan, nan)
+    """
+    if value.__class__ is int:
+        return value
+    if isinstance(value, str):
+        value = value.replace(',', '')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def search(keywords="", search_url="", max_product_nb=100, pipeline=False,
+           parser=None, html_retention=1, html_dir=None, cache=None,
+           client=None, rate_limiter=None, on_metric=None, checkpoint=None,
+           page_concurrency=1, enrich=False,
+           enrich_concurrency=_DEFAULT_ENRICH_CONCURRENCY,
+           diff_against=None):
+    """Function to get the list of products from amazon
+
+    With `pipeline`, the next result page is downloaded while the products of
+    the current page are extracted.
+    `parser` is the BeautifulSoup parser of the pages ("html.parser", "lxml"
+    or "html5lib"), "html.parser" if None or not installed.
+    `html_retention` is the number of result pages kept in memory in
+    `products.html_pages` (the last one by default, all of them if None, none
+    if 0). The older pages are compressed in the `html_dir` directory if
+    specified.
+    `cache` is an optional `ResponseCache` of the result pages (its hits and
+    misses are counted in `products.stats`).
+    `rate_limiter` is an optional `HostRateLimiter`, slowing down the
+    requests when Amazon shows signs of throttling (CAPTCHA, 503...).
+    `on_metric` is an optional callback, called with the name and the value
+    of each metric added to `products.stats` (ex : `("fetch_time", 0.42)`).
+    `checkpoint` is an optional `CrawlCheckpoint`, recording the progress of
+    the search : it resumes from its last completed page, and the products
+    found by the previous runs (or earlier in the results) are skipped. It
+    can not be used with `pipeline`.
+    With a `page_concurrency` above 1, the pages following the first one are
+    requested concurrently (up to `page_concurrency` at a time) with their
+    page number, once the first page gives the number of pages. If the
+    search URL is not a keywords search (`/s?k=...`), the pages are
+    downloaded one after the other. It can not be used with `pipeline` or
+    `checkpoint`.
+    With `enrich`, the detail page of each product is downloaded (up to
+    `enrich_concurrency` at a time) to add its `brand`, `availability`,
+    `price`, `list_price` and `category`. The details are kept by ASIN in the
+    client (and in the `cache`), so that they are downloaded once.
+    With a `SnapshotStore` as `diff_against`, only the products that changed
+    since the previous results of the search in the store are returned (new,
+    dropped, or with another rank, price, rating or number of reviews), with
+    the `change`, `changed_fields`, `rank` and `previous_<field>` fields, and
+    the results are stored for the next time.
+    `client` is an optional long-lived `Client`, reused to keep its
+    connections alive between searches (the previous arguments are then
+    those of the client) """
+    from amazonscraper.client import Client
+    amz = client
+    if amz is None:
+        amz = Client(parser=parser, html_retention=html_retention,
+                     html_dir=html_dir, cache=cache,
+                     rate_limiter=rate_limiter, on_metric=on_metric)
+    return _search(amz, keywords, search_url, max_product_nb, pipeline,
+                   checkpoint, page_concurrency, enrich, enrich_concurrency,
+                   diff_against)
+
+
+def iter_search(keywords="", search_url="", max_product_nb=100, parser=None,
+                client=None):
+    """Generator of the products found on amazon, page after page : the next
+    result page is only downloaded once the products of the current one have
+    been consumed, and the products are not kept in memory
+
+    `parser` is the BeautifulSoup parser of the pages (see `search`).
+    `client` is an optional `Client` to use (ex : to get its `html_pages`)
+    """
+    from amazonscraper.client import Client
+    amz = client if client is not None else Client(parser=parser)
+    for product_dict_list in amz._iter_pages(keywords=keywords,
+                                             search_url=search_url,
+                                             max_product_nb=max_product_nb,
+                                             keep_products=False):
+        for product_dict in product_dict_list:
+            yield Product(product_dict)
+
+
+def search_many(keywords_list, concurrency=4, max_product_nb=100,
+                max_requests_per_host=None, return_exceptions=False,
+                base_url=_BASE_URL, parser=None, html_retention=1,
+                html_dir=None, cache=None, max_requests_per_second=None,
+                on_metric=None, checkpoint=None, diff_against=None):
+    """Search for several keywords in parallel, over a pool of `concurrency`
+    threads, and yield `(keywords, products)` tuples as the searches complete
+
+    `max_requests_per_host` limits the number of simultaneous requests sent
+    to a same Amazon host (defaults to `concurrency`).
+    If `return_exceptions` is True, a failed search yields
+    `(keywords, exception)` instead of raising the exception.
+    `base_url` is the Amazon domain to search on (ex : https://www.amazon.fr/)
+    `max_requests_per_second` limits the rate of the requests sent to a same
+    Amazon host, adapted to the throttling signs (CAPTCHA, 503...) of the
+    host : it is halved after each of them, and restored little by little
+    after the valid pages.
+    `on_metric` is called from the threads of the searches.
+    `parser`, `html_retention`, `html_dir`, `cache`, `on_metric`,
+    `checkpoint` and `diff_against` : see `search`
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    new_client = _new_client_factory(
+        concurrency, max_requests_per_host, base_url, parser, html_retention,
+        html_dir, cache, max_requests_per_second, on_metric)
 
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = {}
+    try:
+        for keywords in keywords_list:
+            future = executor.submit(
+                _search, new_client(), keywords, "", max_product_nb, False,
+                checkpoint, diff_against=diff_against)
+            futures[future] = keywords
 
-def search(keywords="", search_url="", max_product_nb=100):
-    """Function to get the list of products from amazon"""
-    amz = Client()
+        for future in as_completed(futures):
+            # the results are not kept once they are yielded
+            keywords = futures.pop(future)
+            try:
+                products = future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                products = e
+            yield keywords, products
+    finally:
+        # Do not start the remaining searches if the caller stopped iterating
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def iter_search_many(keywords_list, concurrency=4, max_product_nb=100,
+                     max_requests_per_host=None, return_exceptions=False,
+                     base_url=_BASE_URL, parser=None,
+                     max_requests_per_second=None, on_metric=None):
+    """Search for several keywords in parallel, like `search_many`, but yield
+    `(keywords, product)` tuples as soon as the products of each result page
+    are extracted : the products are not kept in memory, and at most
+    2 pages per search running wait to be consumed (the searches are paused
+    meanwhile), whatever `max_product_nb`.
+
+    If `return_exceptions` is True, a failed search yields
+    `(keywords, exception)` (after the products of its previous pages)
+    instead of raising the exception.
+    The other arguments : see `search_many` """
+    from concurrent.futures import ThreadPoolExecutor
+    import queue
+    import threading
+    new_client = _new_client_factory(
+        concurrency, max_requests_per_host, base_url, parser, 0, None, None,
+        max_requests_per_second, on_metric)
+    # Pages of products (or exceptions) waiting to be consumed, and end of
+    # each search (None)
+    pages = queue.Queue(maxsize=2 * concurrency)
+    stopped = threading.Event()
+
+    def put(item):
+        # give up if the consumer stopped iterating
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run_search(keywords):
+        try:
+            for product_dict_list in new_client()._iter_pages(
+                    keywords=keywords, max_product_nb=max_product_nb,
+                    keep_products=False):
+                put((keywords, product_dict_list))
+                if stopped.is_set():
+                    return
+        except Exception as e:
+            put((keywords, e))
+        finally:
+            put(None)
+
+    keywords_list = list(keywords_list)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = []
+    try:
+        for keywords in keywords_list:
+            futures.append(executor.submit(run_search, keywords))
+        running_nb = len(keywords_list)
+        while running_nb > 0:
+            item = pages.get()
+            if item is None:
+                running_nb -= 1
+                continue
+            keywords, product_dict_list = item
+            if isinstance(product_dict_list, Exception):
+                if not return_exceptions:
+                    raise product_dict_list
+                yield keywords, product_dict_list
+                continue
+            for product_dict in product_dict_list:
+                yield keywords, Product(product_dict)
+    finally:
+        # Stop the searches if the caller stopped iterating
+        stopped.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _new_client_factory(concurrency, max_requests_per_host, base_url, parser,
+                        html_retention, html_dir, cache,
+                        max_requests_per_second, on_metric):
+    """Returns a function creating the clients of concurrent searches, which
+    share their connections, their limit of simultaneous requests per host
+    (`concurrency` by default) and their rate limiter"""
+    from amazonscraper.client import Client, HostSemaphores, new_session
+    from amazonscraper.ratelimit import HostRateLimiter
+    if max_requests_per_host is None:
+        max_requests_per_host = concurrency
+    host_semaphores = HostSemaphores(max_requests_per_host)
+    session = new_session(pool_size=max_requests_per_host)
+    rate_limiter = None
+    if max_requests_per_second is not None:
+        rate_limiter = HostRateLimiter(rate=max_requests_per_second)
+
+    def new_client():
+        return Client(host_semaphores=host_semaphores, base_url=base_url,
+                      parser=parser, html_retention=html_retention,
+                      html_dir=html_dir, cache=cache, session=session,
+                      rate_limiter=rate_limiter, on_metric=on_metric)
+    return new_client
+
+
+async def async_search(keywords="", search_url="", max_product_nb=100,
+                       session=None, parser=None, html_retention=1,
+                       html_dir=None):
+    """Coroutine to get the list of products from amazon, without blocking
+    the event loop (requires aiohttp)
+
+    `session` is an optional `aiohttp.ClientSession`, to share the
+    connections between many searches.
+    `parser`, `html_retention` and `html_dir` : see `search` """
+    from amazonscraper.async_client import AsyncClient
+    async with AsyncClient(session=session, parser=parser,
+                           html_retention=html_retention,
+                           html_dir=html_dir) as amz:
+        product_dict_list = await amz._get_products(
+            keywords=keywords,
+            search_url=search_url,
+            max_product_nb=max_product_nb)
+    return _get_client_products(amz, product_dict_list)
+
+
+def extract_products(html, base_url=_BASE_URL, parser=None):
+    """Extract the products of a saved result page (ex : a page of
+    `products.html_pages`), without sending any request
+
+    `base_url` is the Amazon domain of the page, used to build the product
+    URLs (ex : https://www.amazon.fr/).
+    `parser` : see `search` """
+    from amazonscraper.archive import extract_html
+    product_dict_list, stats = extract_html(html, base_url, parser)
+    products = Products(product_dict_list)
+    products.stats = stats
+    return products
+
+
+def reparse(paths, base_url=_BASE_URL, parser=None, processes=None,
+            chunksize=None, layouts=None):
+    """Extract again the products of saved result pages, over a pool of
+    processes, and yield `(file path, products)` tuples in the order of the
+    files
+
+    `paths` are HTML files (compressed with gzip if they end with .gz) or
+    directories, searched recursively for .html, .htm and .html.gz files.
+    `processes` is the number of processes (the number of CPUs by default).
+    `chunksize` is the number of files sent at once to a process (computed
+    from the number of files and processes if None).
+    `layouts` is a file of layouts loaded by the processes (see
+    `load_layouts`), as they do not share the layouts loaded by the current
+    process.
+    `base_url` and `parser` : see `extract_products` """
+    from amazonscraper.archive import extract_files
+    for path, product_dict_list, stats in extract_files(
+            paths, base_url, parser=parser, processes=processes,
+            chunksize=chunksize, layouts=layouts):
+        products = Products(product_dict_list)
+        products.stats = stats
+        yield path, products
+
+
+def _search(amz, keywords, search_url, max_product_nb, pipeline=False,
+            checkpoint=None, page_concurrency=1, enrich=False,
+            enrich_concurrency=_DEFAULT_ENRICH_CONCURRENCY,
+            diff_against=None):
+    """Run a search with the client `amz` and return the `Products`"""
     product_dict_list = amz._get_products(
         keywords=keywords,
         search_url=search_url,
-        max_product_nb=max_product_nb)
+        max_product_nb=max_product_nb,
+        pipeline=pipeline,
+        checkpoint=checkpoint,
+        page_concurrency=page_concurrency)
+    if enrich:
+        amz._enrich_products(product_dict_list, enrich_concurrency)
+    products = _get_client_products(amz, product_dict_list)
+    if diff_against is not None:
+        products = _diff_products(amz, keywords, search_url, products,
+                                  diff_against)
+    return products
+
+
+def _diff_products(amz, keywords, search_url, products, snapshots):
+    """Returns the `Products` that changed since the previous snapshot of
+    the search in the `SnapshotStore` (see `SnapshotStore.update`)"""
+    from amazonscraper.cache import cache_key
+    if search_url == "":
+        search_url = amz._get_search_url(keywords)
+    changed_products = Products()
+    changed_products.products = snapshots.update(
+        cache_key(search_url, amz.headers['Host']), products.products)
+    for product in changed_products:
+        amz._record('diff_' + product.change)
+    changed_products.stats = products.stats
+    changed_products.html_pages = products.html_pages
+    changed_products.last_html_page = products.last_html_page
+    return changed_products
+
+
+def _get_client_products(amz, product_dict_list):
+    """Build the `Products` found by the client `amz`"""
     products = Products(product_dict_list)
+    products.stats = amz.stats
     products.html_pages = amz.html_pages
-    products.last_html_page = amz.html_pages[-1]
+    products.last_html_page = amz.html_pages.last
 
     return products
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Module to extract again the products of archived result pages (ex : after
+fixing a selector), over a pool of processes
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import os
+from amazonscraper.client import Client, load_layouts
+
+# Extensions of the archived pages (the pages spilled by `HtmlPages` are
+# compressed)
+_HTML_FILE_EXTENSIONS = ('.html', '.htm', '.html.gz')
+# Maximum number of files sent at once to a process
+_MAX_CHUNKSIZE = 64
+# Number of chunks submitted in advance, per process (the results of the
+# other chunks are not kept in memory)
+_CHUNKS_PER_PROCESS = 2
+
+
+def list_html_files(paths):
+    """ Returns the HTML files of `paths`, searched recursively in the
+    directories (sorted, to get the same order at each run) """
+    file_list = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, file_names in sorted(os.walk(path)):
+                file_list.extend(
+                    os.path.join(directory, file_name)
+                    for file_name in sorted(file_names)
+                    if file_name.endswith(_HTML_FILE_EXTENSIONS))
+        else:
+            file_list.append(path)
+    return file_list
+
+
+def read_html_file(path):
+    """ Returns the content of an HTML file, compressed or not """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return f.read()
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def get_chunksize(file_nb, processes):
+    """ Returns the number of files sent at once to a process : the files are
+    split in about 4 chunks per process, to balance the load between them
+    while limiting the communications between processes
+    >>> get_chunksize(100000, 8)
+    64
+    >>> get_chunksize(100, 8)
+    3
+    >>> get_chunksize(3, 8)
+    1
+    """
+    return max(1, min(_MAX_CHUNKSIZE, file_nb // (4 * processes)))
+
+
+def extract_html(page, base_url, parser=None):
+    """ Returns the product dicts and the statistics of the extraction of all
+    the products of a result page, with a new client (so that the result
+    does not depend on the pages extracted before) """
+    amz = Client(base_url=base_url, parser=parser, html_retention=0)
+    amz._update_headers(base_url)
+    amz._extract_all_products(page)
+    return amz.product_dict_list, amz.stats
+
+
+def _extract_file(path, base_url, parser):
+    return extract_html(read_html_file(path), base_url, parser)
+
+
+def _extract_chunk(paths, base_url, parser):
+    return [_extract_file(path, base_url, parser) for path in paths]
+
+
+def _iter_chunk_results(chunk, future):
+    for path, (product_dict_list, stats) in zip(chunk, future.result()):
+        yield path, product_dict_list, stats
+
+
+def extract_files(paths, base_url, parser=None, processes=None,
+                  chunksize=None, layouts=None):
+    """ Generator of `(file path, product dicts, statistics)` tuples of the
+    HTML files of `paths`, in the order of `list_html_files`.
+
+    The files are extracted by a pool of `processes` processes (the number of
+    CPUs by default, in the current process if 1), by chunks of `chunksize`
+    files (see `get_chunksize` if None), with the layouts of the file
+    `layouts` (see `load_layouts`) if not None : the processes do not share
+    the layouts loaded by the current process """
+    file_list = list_html_files(paths)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(file_list) <= 1:
+        if layouts is not None:
+            load_layouts(layouts)
+        for path in file_list:
+            yield (path,) + _extract_file(path, base_url, parser)
+        return
+
+    if chunksize is None:
+        chunksize = get_chunksize(len(file_list), processes)
+    chunks = (file_list[start:start + chunksize]
+              for start in range(0, len(file_list), chunksize))
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=None if layouts is None else load_layouts,
+        initargs=(layouts,))
+    # (chunk, future) of the chunks being extracted, in the order of the files
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(
+                _extract_chunk, chunk, base_url, parser)))
+            if len(pending) >= _CHUNKS_PER_PROCESS * processes:
+                yield from _iter_chunk_results(*pending.popleft())
+        while pending:
+            yield from _iter_chunk_results(*pending.popleft())
+    finally:
+        # Do not extract the remaining files if the caller stopped iterating
+        for chunk, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Module to get the product info on Amazon from an asyncio event loop
+"""
+
+import asyncio
+import time
+from amazonscraper.client import Client, StatusCodeError, logger, _BASE_URL, \
+    _MAX_TRIAL_REQUESTS
+from amazonscraper.ratelimit import get_backoff_delay
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp is an optional dependency
+    aiohttp = None
+
+
+class AsyncClient(Client):
+    """Do the requests with the Amazon servers, without blocking the event
+    loop (the HTML pages are parsed like with `Client`)"""
+
+    def __init__(self, session=None, base_url=_BASE_URL, parser=None,
+                 html_retention=1, html_dir=None, rate_limiter=None,
+                 on_metric=None):
+        """ Init of the client
+
+        `session` is an optional `aiohttp.ClientSession`, that may be shared
+        between many clients. If None, a session is created on the first
+        request and closed by `close()`.
+        `parser`, `html_retention`, `html_dir`, `rate_limiter` and
+        `on_metric` : see `Client` """
+        if aiohttp is None:
+            raise ImportError(
+                'AsyncClient requires aiohttp (pip install aiohttp)')
+        super().__init__(base_url=base_url, parser=parser,
+                         html_retention=html_retention, html_dir=html_dir,
+                         session=session, rate_limiter=rate_limiter,
+                         on_metric=on_metric)
+        self._owns_session = session is None
+
+    def _new_session(self, pool_size):
+        # the aiohttp session is created on the first request (in the event
+        # loop), not a requests session
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """ Close the session, if it was created by the client """
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _get(self, url):
+        """ GET request with the proper headers, returns the page content """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        if self.rate_limiter is not None:
+            await asyncio.sleep(
+                self.rate_limiter.reserve(self.headers['Host']))
+        start = time.perf_counter()
+        async with self.session.get(url, headers=self.headers) as ret:
+            body = await ret.read()
+            content = await ret.text()
+            self._record('requests')
+            self._record('fetch_time', time.perf_counter() - start)
+            self._record('bytes_downloaded', len(body))
+            if ret.status != 200:
+                raise StatusCodeError(
+                    'Status code {status} for url {url}\n{content}'.format(
+                        status=ret.status, url=url, content=content),
+                    ret.status)
+        return content
+
+    async def _get_page_html(self, search_url):
+        """Retrieve the page at `search_url`"""
+        trials = 0
+        content = None
+
+        while trials < _MAX_TRIAL_REQUESTS:
+
+            logger.debug('Trying user agent: %s', self.headers['User-Agent'])
+            trials += 1
+            try:
+                content = await self._get(search_url)
+
+                failure = self._get_page_failure(content)
+
+            # To counter the "SSLError bad handshake" exception
+            except aiohttp.ClientSSLError:
+                failure = 'ssl'
+
+            except StatusCodeError as e:
+                failure = 'server_error' if e.status_code >= 500 \
+                    else 'http_error'
+
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    ConnectionError):
+                failure = 'http_error'
+
+            valid_page = self._report_page(failure)
+            if valid_page:
+                break
+
+            if trials < _MAX_TRIAL_REQUESTS:
+                self._record('retries')
+                await asyncio.sleep(get_backoff_delay(failure, trials))
+
+        if not valid_page:
+            raise ValueError('No valid pages found! Perhaps the page returned is a CAPTCHA? Check products.last_html_page')
+        return content
+
+    async def _get_products(self, keywords="", search_url="",
+                            max_product_nb=100):
+
+        self._start_search()
+        if search_url == "":
+            search_url = self._get_search_url(keywords)
+        self._update_headers(search_url)
+
+        while len(self.product_dict_list) < max_product_nb:
+
+            # get the html of the specified page
+            page = await self._get_page_html(search_url)
+            self.html_pages.append(page)
+
+            # extract the needed products from the page, and get the url of
+            # the next page
+            soup, plan, products = self._parse_page(page)
+            search_url = self._get_next_page_url(soup, plan)
+            self._extract_products(products, plan, max_product_nb)
+
+            # the last page is enough if it has the products needed
+            if len(self.product_dict_list) < max_product_nb and \
+                    search_url is None:
+                raise(ValueError('Could not find the URL of the next page of results!'))
+
+        return self.product_dict_list
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Module to cache the result pages downloaded from Amazon
+"""
+
+from collections import namedtuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import time
+from amazonscraper.database import Database
+
+# Query parameters that change at each search without changing the results
+_IGNORED_QUERY_PARAMETERS = frozenset(['qid', 'ref', 'sr'])
+
+CachedResponse = namedtuple(
+    'CachedResponse', ['content', 'etag', 'last_modified', 'stored_at'])
+
+
+def cache_key(url, host):
+    """ Returns the cache key of the `url` requested on the `host`
+    (normalized, so that equivalent search URLs share the same entry)
+    >>> print(cache_key("HTTPS://www.Amazon.com/s?page=2&k=python&qid=1234",\
+ "www.amazon.com"))
+    www.amazon.com https://www.amazon.com/s?k=python&page=2
+    """
+    parts = urlsplit(url)
+    query = sorted((name, value)
+                   for name, value in parse_qsl(parts.query,
+                                                keep_blank_values=True)
+                   if name not in _IGNORED_QUERY_PARAMETERS)
+    normalized_url = urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                                 parts.path, urlencode(query), ''))
+    return host.lower() + ' ' + normalized_url
+
+
+class ResponseCache(object):
+    """SQLite cache of the result pages, that may be shared between threads
+    and processes. The entries are fresh during `ttl` seconds, then they are
+    revalidated with their ETag / Last-Modified headers. Beyond `max_entries`,
+    the least recently used entries are evicted.
+
+    Another cache backend can be used by the clients, as long as it provides
+    the `get`, `is_fresh`, `set` and `refresh` methods """
+
+    def __init__(self, path, ttl=3600, max_entries=10000):
+        """
+        >>> cache = ResponseCache(":memory:", max_entries=2)
+        >>> for key in ["a", "b", "c"]:
+        ...     cache.set(key, "<html>" + key, etag='"' + key + '"')
+        >>> cache.get("a") is None
+        True
+        >>> print(cache.get("c").content, cache.get("c").etag)
+        <html>c "c"
+        >>> cache.is_fresh(cache.get("c"))
+        True
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._database = Database(path, [
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, content TEXT, etag TEXT, '
+            'last_modified TEXT, stored_at REAL, last_access REAL)',
+            'CREATE INDEX IF NOT EXISTS responses_last_access '
+            'ON responses (last_access)'])
+
+    def get(self, key):
+        """ Returns the `CachedResponse` of the key, or None """
+        with self._database.connect() as connection:
+            row = connection.execute(
+                'SELECT content, etag, last_modified, stored_at '
+                'FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            with connection:
+                connection.execute(
+                    'UPDATE responses SET last_access = ? WHERE key = ?',
+                    (time.time(), key))
+        return CachedResponse(*row)
+
+    def is_fresh(self, cached_response):
+        """ Returns True if the response can be used without revalidation """
+        return time.time() - cached_response.stored_at < self.ttl
+
+    def set(self, key, content, etag=None, last_modified=None):
+        """ Store the content of the response of the key """
+        now = time.time()
+        with self._database.connect() as connection, connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, content, etag, last_modified, now, now))
+            connection.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses '
+                'ORDER BY last_access DESC, rowid DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def refresh(self, key):
+        """ Mark the response of the key as fresh again (after a successful
+        revalidation) """
+        with self._database.connect() as connection, connection:
+            connection.execute(
+                'UPDATE responses SET stored_at = ? WHERE key = ?',
+                (time.time(), key))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Module to save the progress of the searches, to resume them and to skip the
+products already found
+"""
+
+from collections import namedtuple
+import time
+from amazonscraper.database import Database
+
+# `next_url` is the URL of the next page to download, `page_nb` the number of
+# pages completed, and `complete` is True once the last page of results has
+# been reached
+CrawlState = namedtuple('CrawlState', ['next_url', 'page_nb', 'complete'])
+
+
+class CrawlCheckpoint(object):
+    """SQLite checkpoint of the searches, that may be shared between threads
+    and processes. For each search, it keeps the URL of the next page to
+    download and the ASINs of the products already found.
+
+    A search interrupted (ex : after a crash) resumes from the last completed
+    page. Once all its pages have been downloaded, the search starts again
+    from the first page, but only the new products are returned """
+
+    def __init__(self, path):
+        """
+        >>> checkpoint = CrawlCheckpoint(":memory:")
+        >>> checkpoint.save_page("python", "https://www.amazon.com/s?page=2",
+        ...                      1, ["B01", "B02"])
+        >>> checkpoint.get("python")
+        CrawlState(next_url='https://www.amazon.com/s?page=2', page_nb=1, \
+complete=False)
+        >>> sorted(checkpoint.filter_seen("python", ["B02", "B03"]))
+        ['B02']
+        >>> checkpoint.get("scraping") is None
+        True
+        """
+        self.path = path
+        self._database = Database(path, [
+            'CREATE TABLE IF NOT EXISTS searches ('
+            'key TEXT PRIMARY KEY, next_url TEXT, page_nb INTEGER, '
+            'complete INTEGER, updated_at REAL)',
+            # one compact row per ASIN (the primary key is the table)
+            'CREATE TABLE IF NOT EXISTS seen_asins ('
+            'key TEXT, asin TEXT, PRIMARY KEY (key, asin)) WITHOUT ROWID'])
+
+    def get(self, key):
+        """ Returns the `CrawlState` of the search, or None """
+        with self._database.connect() as connection:
+            row = connection.execute(
+                'SELECT next_url, page_nb, complete FROM searches '
+                'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return CrawlState(row[0], row[1], bool(row[2]))
+
+    def filter_seen(self, key, asins):
+        """ Returns the set of the `asins` already found by the search """
+        asins = list(set(asins))
+        seen = set()
+        with self._database.connect() as connection:
+            # by batches, below the limit of SQLite parameters
+            for start in range(0, len(asins), 500):
+                batch = asins[start:start + 500]
+                seen.update(row[0] for row in connection.execute(
+                    'SELECT asin FROM seen_asins WHERE key = ? AND asin IN '
+                    '(' + ', '.join('?' * len(batch)) + ')', [key] + batch))
+        return seen
+
+    def save_page(self, key, next_url, page_nb, asins, complete=False):
+        """ Record the progress of the search after a page : the ASINs of its
+        products, the URL of the next page to download and the number of
+        pages completed (in a single transaction, so that the checkpoint
+        stays consistent after a crash) """
+        with self._database.connect() as connection, connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO seen_asins VALUES (?, ?)',
+                [(key, asin) for asin in asins])
+            connection.execute(
+                'INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?)',
+                (key, next_url, page_nb, int(complete), time.time()))
+
+    def reset(self, key):
+        """ Forget the progress and the products of the search """
+        with self._database.connect() as connection, connection:
+            connection.execute('DELETE FROM searches WHERE key = ?', (key,))
+            connection.execute('DELETE FROM seen_asins WHERE key = ?', (key,))
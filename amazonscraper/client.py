@@ -3,14 +3,32 @@
 Module to get and parse the product info on Amazon
 """
 
+import json
+import logging
+import os
 import requests
 import re
-from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from collections import Counter
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, \
+    urlencode
+from bs4 import BeautifulSoup, NavigableString, Tag
+from bs4.builder import builder_registry
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
+import soupsieve
+from amazonscraper.cache import cache_key
+from amazonscraper.defaults import _BASE_URL, _DEFAULT_ENRICH_CONCURRENCY
+from amazonscraper.html_pages import HtmlPages
+from amazonscraper.ratelimit import get_backoff_delay
+import threading
 import time
 
-_BASE_URL = "https://www.amazon.com/"
+logger = logging.getLogger(__name__)
+
 _DEFAULT_BEAUTIFULSOUP_PARSER = "html.parser"
+# Parsers that can be used by BeautifulSoup (if installed). They build the
+# same tree for the result pages, so the products are identical
+_BEAUTIFULSOUP_PARSER_LIST = ["html.parser", "lxml", "html5lib"]
 _DEFAULT_USER_AGENT = 'Mozilla/5.0 (Linux; Android 7.0; \
 SM-A520F Build/NRD90M; wv) AppleWebKit/537.36 \
 (KHTML, like Gecko) Version/4.0 \
@@ -72,19 +90,179 @@ _CSS_SELECTOR_LIST = [
                         _CSS_SELECTORS_DESKTOP,
                         _CSS_SELECTORS_DESKTOP_2,
                      ]
+# Names of the layouts above, used in the statistics of the client
+_LAYOUT_NAME_LIST = ["mobile", "mobile_grid", "desktop", "desktop_2"]
+# Selectors required by a layout, and optional ones (the title and
+# review_nb of the products are also searched with the fallback selectors
+# below, after those of the layout)
+_REQUIRED_LAYOUT_SELECTORS = ("product", "url", "img", "next_page_url")
+_OPTIONAL_LAYOUT_SELECTORS = ("title", "review_nb")
+
+# Fallback selectors of the fields that do not depend on the layout
+_TITLE_CSS_SELECTORS = [
+    'h5 span',
+    "a.s-access-detail-page > h2",
+    "div div.sg-row  h5 > span"
+]
+_N_RATINGS_CSS_SELECTORS = [
+    "div.a-row.a-size-small span.a-size-base",
+    "div div.sg-row .a-spacing-top-mini span.a-size-small",
+    "div.a-column.a-span5.a-span-last > div.a-row.a-spacing-mini > a.a-size-small.a-link-normal.a-text-normal",
+]
+
+# match the ratings of the Amazon domains (ex : "4.5 out of 5",
+# "4,5 sur 5", "4,5 von 5", "5つ星のうち4.5")
+_RATING_REGEX = re.compile(
+    r'(\d[.,]\d)\s(?:out of|sur|von|su|de|van|z)\s5|5つ星のうち(\d[.,]\d)')
+# match all prices with a currency symbol and cents (ex : $X,XXX.XX, £X.XX,
+# X XXX,XX €)
+_PRICE_REGEX = re.compile(
+    r'(?:[$£¥￥₹]|€\s?)(\d[\d,.\u00a0\u202f]*[.,]\d\d)(?!\d)'
+    r'|(?<![\d,.])(\d[\d,.\u00a0\u202f]*[.,]\d\d)\s?(?:€|zł|kr)')
+# match the prices without cents (ex : ¥1,234), only when they are the whole
+# text, so that the amounts of the sentences (ex : "FREE Shipping on orders
+# over $25") are not taken for prices
+_WHOLE_PRICE_REGEX = re.compile(
+    r'\s*(?:(?:[$£¥￥₹]|€\s?)(\d(?:[\d,.\u00a0\u202f]*\d)?)'
+    r'|(\d(?:[\d,.\u00a0\u202f]*\d)?)\s?(?:€|zł|kr))\s*')
+# Domains writing the numbers with a decimal comma (ex : 1.234,56 €)
+_DECIMAL_COMMA_DOMAINS = ('.fr', '.de', '.it', '.es', '.nl', '.com.be',
+                          '.com.br', '.pl', '.se', '.com.tr')
+# Thousands separators of the numbers, removed before their conversion
+_THOUSANDS_SEPARATORS_REGEX = {
+    '.': re.compile(r'[,\s]'),
+    ',': re.compile(r'[.\s]'),
+}
+
+# Pagination links of the layouts above, searched directly in the HTML
+_NEXT_PAGE_LINK_REGEX = re.compile(
+    r'<li class="a-last">\s*(<a [^>]*>)|(<a [^>]*id="pagnNextLink"[^>]*>)')
+_HREF_REGEX = re.compile(r'href="([^"]*)"')
+
+# Fields of the product detail pages (/dp/ASIN), not on the result pages
+_DETAIL_CSS_SELECTORS = {
+    "brand": "#bylineInfo",
+    "availability": "#availability",
+    "price": "#corePrice_feature_div .a-price:not(.a-text-price) > \
+.a-offscreen, #priceblock_ourprice, #price_inside_buybox",
+    "list_price": ".basisPrice .a-offscreen, \
+#corePrice_feature_div .a-text-price > .a-offscreen",
+    "category": "#wayfinding-breadcrumbs_feature_div li a",
+}
+_DETAIL_PRICE_FIELDS = ('price', 'list_price')
+# match the brands displayed as "Visit the X Store" or "Brand: X"
+_BRAND_REGEX = re.compile(
+    r'^(?:Visit the (.+) Store|(?:Brand|Marque|Marke|Marca)\s*:\s*(.+))$')
+
+# Page numbers of the pagination of the layouts above
+_PAGINATION_SELECTOR = soupsieve.compile("ul.a-pagination > li, #pagn > span")
+
+# Default maximum number of connections kept alive per Amazon domain
+_DEFAULT_POOL_SIZE = 10
 
 # Maximum number of requests to do if Amazon returns a bad page (anti-scraping)
 _MAX_TRIAL_REQUESTS = 5
-_WAIT_TIME_BETWEEN_REQUESTS = 1
 
+# Size of the beginning of the pages checked before downloading the rest (the
+# texts of the invalid pages are near their beginning), and size of the
+# chunks read
+_VALIDATION_HEAD_SIZE = 32 * 1024
+_CHUNK_SIZE = 16 * 1024
+
+# Texts of the invalid pages, by type of failure
+_INVALID_PAGE_TEXTS = [
+    ("Sign in for the best experience", 'sign_in'),
+    ("The request could not be satisfied.", 'not_satisfied'),
+    ("Robot Check", 'robot_check'),
+]
 
-class Client(object):
-    """Do the requests with the Amazon servers"""
 
-    def __init__(self):
-        """ Init of the client """
+def new_session(pool_size=_DEFAULT_POOL_SIZE):
+    """ Returns a requests session keeping alive up to `pool_size`
+    connections per Amazon domain, to be shared by several clients (requests
+    does not support HTTP/2, the connections are HTTP/1.1 keep-alive ones)
+    >>> session = new_session(pool_size=4)
+    >>> session.get_adapter("https://www.amazon.fr/")._pool_maxsize
+    4
+    """
+    session = requests.session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class StatusCodeError(ConnectionError):
+    """The Amazon server answered with an unexpected status code"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class HostSemaphores(object):
+    """Limit the number of concurrent requests sent to each Amazon host"""
+
+    def __init__(self, max_requests_per_host):
+        """
+        >>> hs = HostSemaphores(max_requests_per_host=2)
+        >>> hs.get('www.amazon.com') is hs.get('www.amazon.com')
+        True
+        >>> hs.get('www.amazon.com') is hs.get('www.amazon.fr')
+        False
+        """
+        self.max_requests_per_host = max_requests_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """ Returns the semaphore associated to `host` """
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(
+                    self.max_requests_per_host)
+                self._semaphores[host] = semaphore
+        return semaphore
+
 
-        self.session = requests.session()
+class Client(object):
+    """Do the requests with the Amazon servers.
+    A client runs one search at a time, but it can be reused for many
+    searches, keeping its connections alive"""
+
+    def __init__(self, host_semaphores=None, base_url=_BASE_URL,
+                 parser=None, html_retention=1, html_dir=None, cache=None,
+                 session=None, pool_size=_DEFAULT_POOL_SIZE,
+                 rate_limiter=None, on_metric=None):
+        """ Init of the client
+
+        `host_semaphores` is an optional `HostSemaphores` object, shared
+        between clients running concurrently to limit the number of
+        simultaneous requests sent to a same Amazon host.
+        `base_url` is the Amazon domain used to build the keywords searches.
+        `parser` is the BeautifulSoup parser of the pages ("html.parser",
+        "lxml" or "html5lib"), "html.parser" if None or not installed.
+        `html_retention` is the number of downloaded pages kept in memory in
+        `html_pages` (the last one by default, all of them if None, none if
+        0). The older pages are compressed in the `html_dir` directory if
+        specified.
+        `cache` is an optional `ResponseCache`, where the valid pages are
+        stored and looked up before sending a request.
+        `session` is an optional requests session (see `new_session`) shared
+        with other clients. If None, a session keeping alive up to
+        `pool_size` connections per Amazon domain is created.
+        `rate_limiter` is an optional `HostRateLimiter`, shared between
+        clients running concurrently to adapt the rate of the requests sent
+        to each Amazon host.
+        `on_metric` is an optional callback, called with the name and the
+        value of each metric as it is added to `stats` (ex : `("fetch_time",
+        0.42)`), to feed a monitoring system
+        """
+
+        if session is None:
+            session = self._new_session(pool_size)
+        self.session = session
         self.current_user_agent_index = 0
         self.headers = {
                     'Host': 'www.amazon.com',
@@ -92,8 +270,49 @@ class Client(object):
                     'Accept': 'text/html,application/xhtml+xml,\
                         application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
                     }
+        self.html_retention = html_retention
+        self.html_dir = html_dir
+        self.host_semaphores = host_semaphores
+        self.rate_limiter = rate_limiter
+        self.on_metric = on_metric
+        self.cache = cache
+        self.base_url = base_url
+        self.parser = _get_beautifulsoup_parser(parser)
+        # Layouts (`_ExtractionPlan`) and field selectors (indexes) that
+        # worked on the previous pages, by host
+        self._layout_cache = {}
+        self._field_selector_cache = {}
+        # Fields of the detail pages already extracted, by (host, ASIN)
+        self._detail_cache = {}
+        self._start_search()
+
+    def _new_session(self, pool_size):
+        """ Returns the session of the client, if none is given """
+        return new_session(pool_size=pool_size)
+
+    def _start_search(self):
+        """ Reset the products, pages and statistics of the previous search
+        (the connections and the layout caches are kept) """
         self.product_dict_list = []
-        self.html_pages = []
+        self.html_pages = HtmlPages(max_pages_in_memory=self.html_retention,
+                                    spill_dir=self.html_dir)
+        # Statistics counters (ex : cache hits and misses, time spent)
+        self.stats = Counter()
+        # The pages may be downloaded by several threads
+        self._stats_lock = threading.Lock()
+
+    def _record(self, metric, value=1):
+        """ Add `value` to the `metric` of the statistics
+        >>> c = Client()
+        >>> c._record('fetch_time', 0.5)
+        >>> c._record('fetch_time', 0.25)
+        >>> c.stats['fetch_time']
+        0.75
+        """
+        with self._stats_lock:
+            self.stats[metric] += value
+        if self.on_metric is not None:
+            self.on_metric(metric, value)
 
     def _change_user_agent(self):
         """ Change the User agent of the requests
@@ -117,14 +336,76 @@ class Client(object):
         self.headers['User-Agent'] = _USER_AGENT_LIST[index]
         self.current_user_agent_index = index
 
-    def _get(self, url):
-        """ GET request with the proper headers """
-        ret = self.session.get(url, headers=self.headers)
-        if ret.status_code != 200:
-            raise ConnectionError(
-                'Status code {status} for url {url}\n{content}'.format(
-                    status=ret.status_code, url=url, content=ret.text))
-        return ret
+    def _get(self, url, conditional_headers=None):
+        """ GET request with the proper headers. Returns the response, its
+        text, and the type of failure of the page (None if it is valid, see
+        `_get_page_failure`).
+        With `conditional_headers` (If-None-Match / If-Modified-Since), a 304
+        (Not Modified) response is accepted """
+        headers = self.headers
+        if conditional_headers:
+            headers = dict(self.headers, **conditional_headers)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.headers['Host'])
+        if self.host_semaphores is None:
+            return self._fetch(url, headers, conditional_headers)
+        with self.host_semaphores.get(self.headers['Host']):
+            return self._fetch(url, headers, conditional_headers)
+
+    def _fetch(self, url, headers, conditional_headers):
+        """ Send the request and read the response (see `_get`) """
+        start = time.perf_counter()
+        with self.session.get(url, headers=headers, stream=True) as ret:
+            self._record('requests')
+            if ret.status_code == 304 and conditional_headers:
+                text, failure = "", None
+            elif ret.status_code != 200:
+                raise StatusCodeError(
+                    'Status code {status} for url {url}\n{content}'.format(
+                        status=ret.status_code, url=url, content=ret.text),
+                    ret.status_code)
+            else:
+                text, failure = self._read_page(ret)
+            self._record('fetch_time', time.perf_counter() - start)
+        return ret, text, failure
+
+    def _read_page(self, ret):
+        """ Read the body of the response `ret`, and returns its text and the
+        type of failure of the page. The beginning of the body is checked
+        first : the transfer of an invalid page is aborted, without reading
+        nor decoding the rest. A valid body is decoded once """
+        encoding = ret.encoding or 'utf-8'
+        chunks = []
+        size = 0
+        body_chunks = ret.iter_content(chunk_size=_CHUNK_SIZE)
+        for chunk in body_chunks:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= _VALIDATION_HEAD_SIZE:
+                break
+        failure = self._get_page_failure(
+            b''.join(chunks).decode(encoding, errors='replace'))
+        if failure is not None:
+            # the connection is closed with the response, before the end of
+            # the body
+            self._record('bytes_downloaded', size)
+            self._record('aborted_transfers')
+            content_length = ret.headers.get('Content-Length', '')
+            if content_length.isdigit():
+                self._record('bytes_saved',
+                             max(0, int(content_length) - ret.raw.tell()))
+            return "", failure
+
+        head_size = size
+        for chunk in body_chunks:
+            chunks.append(chunk)
+            size += len(chunk)
+        self._record('bytes_downloaded', size)
+        text = b''.join(chunks).decode(encoding, errors='replace')
+        if size > head_size:
+            # the texts of the invalid pages may also be after the beginning
+            failure = self._get_page_failure(text)
+        return text, failure
 
     def _update_headers(self, search_url):
         """ Update the 'Host' field in the header with the proper Amazon domain
@@ -134,9 +415,12 @@ class Client(object):
         >>> c._update_headers("https://www.amazon.fr/s/lkdjsdlkjlk")
         >>> print(c.headers['Host'])
         www.amazon.fr
+        >>> c._update_headers("http://127.0.0.1:8000/s?k=python")
+        >>> print(c.base_url)
+        http://127.0.0.1:8000/
         """
-        self.base_url = "https://" + \
-            search_url.split("://")[1].split("/")[0] + "/"
+        scheme, _, path = search_url.partition("://")
+        self.base_url = scheme + "://" + path.split("/")[0] + "/"
         self.headers['Host'] = self.base_url.split("://")[1].split("/")[0]
 
     def _get_search_url(self, keywords):
@@ -144,158 +428,221 @@ class Client(object):
         >>> c = Client()
         >>> print(c._get_search_url(keywords="python"))
         https://www.amazon.com/s?k=python
+        >>> c = Client(base_url="https://www.amazon.fr/")
+        >>> print(c._get_search_url(keywords="python"))
+        https://www.amazon.fr/s?k=python
         """
-        search_url = urljoin(_BASE_URL, ("s?k=%s" % (keywords)))
-        return search_url
+        return _build_search_url(self.base_url, keywords)
 
     def _check_page(self, html_content):
         """Check if the page is a valid result page
         (even if there is no result) """
-        if "Sign in for the best experience" in html_content:
-            valid_page = False
-        elif "The request could not be satisfied." in html_content:
-            valid_page = False
-        elif "Robot Check" in html_content:
-            valid_page = False
-        else:
-            valid_page = True
-        return valid_page
+        return self._get_page_failure(html_content) is None
+
+    def _report_page(self, failure):
+        """ Adapt the rate of the requests and the user agent to the result of
+        the last request (`failure` is None for a valid page).
+        Returns True if the page is valid """
+        host = self.headers['Host']
+        if failure is None:
+            if self.rate_limiter is not None:
+                self.rate_limiter.on_success(host)
+            return True
+        logger.info('Invalid page from %s (%s)', host, failure)
+        self._record('failures_' + failure)
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_failure(host, failure)
+        if failure not in ('ssl', 'server_error'):
+            # The page was refused to this user agent
+            self._change_user_agent()
+            self._record('user_agent_switches')
+        return False
+
+    def _get_page_failure(self, html_content):
+        """Returns the type of failure of an invalid page ('sign_in',
+        'not_satisfied' or 'robot_check'), or None if the page is valid
+        >>> c = Client()
+        >>> print(c._get_page_failure("<title>Robot Check</title>"))
+        robot_check
+        >>> print(c._get_page_failure("<title>Amazon.com : python</title>"))
+        None
+        """
+        for text, failure in _INVALID_PAGE_TEXTS:
+            if text in html_content:
+                return failure
+        return None
 
 
     def _get_page_html(self, search_url):
-        """Retrieve the page at `search_url`"""
+        """Retrieve the page at `search_url` (from the cache if it is fresh)"""
         trials = 0
         res = None
+        text = None
+        cached_response = None
+        conditional_headers = None
+
+        if self.cache is not None:
+            key = cache_key(search_url, self.headers['Host'])
+            cached_response = self.cache.get(key)
+            if cached_response is None:
+                self._record('cache_misses')
+            elif self.cache.is_fresh(cached_response):
+                self._record('cache_hits')
+                return cached_response.content
+            else:
+                conditional_headers = _get_conditional_headers(
+                    cached_response)
 
         while trials < _MAX_TRIAL_REQUESTS:
 
-            print('Trying user agent: {}'.format(self.headers['User-Agent']))
+            logger.debug('Trying user agent: %s', self.headers['User-Agent'])
             trials += 1
             try:
-                res = self._get(search_url)
+                res, text, failure = self._get(search_url,
+                                               conditional_headers)
 
-                valid_page = self._check_page(res.text)
+                if res.status_code == 304:
+                    # The cached page is still valid
+                    self.cache.refresh(key)
+                    self._record('cache_revalidations')
+                    return cached_response.content
 
             # To counter the "SSLError bad handshake" exception
             except requests.exceptions.SSLError:
-                valid_page = False
+                failure = 'ssl'
+
+            except StatusCodeError as e:
+                failure = 'server_error' if e.status_code >= 500 \
+                    else 'http_error'
 
             except ConnectionError:
-                valid_page = False
+                failure = 'http_error'
 
+            valid_page = self._report_page(failure)
             if valid_page:
                 break
 
-            self._change_user_agent()
-            time.sleep(_WAIT_TIME_BETWEEN_REQUESTS)
+            if trials < _MAX_TRIAL_REQUESTS:
+                self._record('retries')
+                time.sleep(get_backoff_delay(failure, trials))
 
         if not valid_page:
             raise ValueError('No valid pages found! Perhaps the page returned is a CAPTCHA? Check products.last_html_page')
-        return res.text
 
-    def _get_n_ratings(self, product):
-        """Given the HTML of a `product`, extract the number of ratings"""
+        if self.cache is not None:
+            if cached_response is not None:
+                # The cached page was stale and has changed
+                self._record('cache_misses')
+            self.cache.set(key, text,
+                           etag=res.headers.get('ETag'),
+                           last_modified=res.headers.get('Last-Modified'))
+        return text
+
+    def _get_n_ratings(self, product_matches):
+        """Given the `_ExtractionPlan` matches of a product, extract the
+        number of ratings"""
 
-        n_ratings_css_selectors = [
-            "div.a-row.a-size-small span.a-size-base",
-            "div div.sg-row .a-spacing-top-mini span.a-size-small",
-            "div.a-column.a-span5.a-span-last > div.a-row.a-spacing-mini > a.a-size-small.a-link-normal.a-text-normal",
-        ]
+        decimal_separator = _get_decimal_separator(self.headers['Host'])
 
-        for selector in n_ratings_css_selectors:
+        for index, element in product_matches['review_nb']:
 
-            n_ratings = _css_select(product, selector)
+            n_ratings = _get_text(element)
 
             try:
-                n_ratings = int(n_ratings.replace(',', ''))
+                n_ratings = int(_remove_separators(n_ratings,
+                                                   decimal_separator))
+                self._record_field_selector('review_nb', index)
                 break
             except ValueError:
                 pass
 
         if not n_ratings:
-            print(f'  Failed to extract number of ratings!')
+            self._record_missing_field('review_nb')
             return float('nan')
 
         return n_ratings
 
 
-    def _get_title(self, product):
-        """Given the HTML of a `product`, extract the title"""
+    def _get_title(self, product_matches):
+        """Given the `_ExtractionPlan` matches of a product, extract the
+        title"""
 
-        title_css_selectors = [
-            'h5 span',
-            "a.s-access-detail-page > h2",
-            "div div.sg-row  h5 > span"
-        ]
+        for index, element in product_matches['title']:
 
-        for selector in title_css_selectors:
-
-            title = _css_select(product, selector)
+            title = _get_text(element)
 
             if title:
+                self._record_field_selector('title', index)
                 break
 
         if not title:
-            print('  Failed to extract title!')
+            self._record_missing_field('title')
 
         return title
 
 
-    def _get_rating(self, product):
-        """Given the HTML of a `product`, extract the average rating"""
+    def _get_rating(self, product_matches):
+        """Given the `_ExtractionPlan` matches of a product, extract the
+        average rating"""
 
-        rating = re.search(r'(\d.\d) out of 5', str(product))
+        rating = product_matches['rating']
 
         if rating:
-            rating = rating.groups()[0]
+            rating = rating.group(1) or rating.group(2)
             # convert string to float and replace European decimal seperator ',' with '.'s
             rating = float(rating.replace(",", "."))
         else:
             rating = float('nan')
-            print(f'  Failed to extract rating!')
+            self._record_missing_field('rating')
 
         return rating
 
 
-    def _get_prices(self, product):
+    def _get_prices(self, product_matches):
         """
-        Given the HTML of a `product`, extract all prices.
+        Given the `_ExtractionPlan` matches of a product, extract all prices.
         """
         # XXX currently does not handle shipping prices or prices for the
         # various formats of books.
 
-        # match all prices of the form $X,XXX.XX:
-        raw_prices = product.find_all(text=re.compile('\$[\d,]+.\d\d'))
+        raw_prices = product_matches['prices']
+        decimal_separator = _get_decimal_separator(self.headers['Host'])
 
+        # prices in the order of the page, without duplicates
         prices = {
-            'prices_per_unit': set(),
-            'units': set(),
-            'prices_main': set(),
+            'prices_per_unit': {},
+            'units': {},
+            'prices_main': {},
         }
 
         # attempt to identify the prices
         for raw_price in raw_prices:
 
             # get the price as a float rather than a string or BeautifulSoup object
-            price = float(re.search('\$([\d,]+.\d\d)', raw_price).groups()[0])
+            match = _search_price(raw_price)
+            price = _parse_number(match.group(1) or match.group(2),
+                                  decimal_separator)
 
             # ignore promotional strikethrough prices
             if raw_price.parent.parent.attrs.get('data-a-strike') == 'true':
                 continue
 
             # ignore promotional freebies
-            elif raw_price == '$0.00':
+            elif price == 0:
                 continue
 
             # extract price per unit price and unit
             elif raw_price.startswith('(') and '/' in raw_price:
                 price_per_unit = re.findall(r'/(.*)\)', raw_price)[0]
-                prices['prices_per_unit'].add(price)
-                prices['units'].add(price_per_unit)
+                prices['prices_per_unit'][price] = None
+                prices['units'][price_per_unit] = None
 
             # any other price is hopefully the main price
             else:
-                prices['prices_main'].add(price)
+                prices['prices_main'][price] = None
+
+        if not prices['prices_main']:
+            self._record_missing_field('price')
 
         # clean up the discoverd prices
         for price_type, price_value in prices.copy().items():
@@ -304,11 +651,20 @@ class Client(object):
                 prices[price_type] = float('nan')
 
             elif len(price_value) == 1:
-                prices[price_type] = price_value.pop()
+                prices[price_type] = next(iter(price_value))
+
+            elif price_type == 'units':
+                prices[price_type] = ', '.join(sorted(price_value))
 
             else:
-                print('  Multiple prices found. Consider selecting a format on Amazon and using that URL!')
-                prices[price_type] = ', '.join(map(str, price_value))
+                # keep the first price shown (ex : of the default format of a
+                # book), as the other ones may be unrelated
+                logger.info('Multiple prices found (%s), keeping the first '
+                            'one. Consider selecting a format on Amazon and '
+                            'using that URL!',
+                            ', '.join(map(str, price_value)))
+                self._record('multiple_prices')
+                prices[price_type] = next(iter(price_value))
 
         return prices
 
@@ -318,18 +674,96 @@ class Client(object):
         the URL of the next page of results
         """
 
-        soup = BeautifulSoup(page, _DEFAULT_BEAUTIFULSOUP_PARSER)
+        soup, plan, products = self._parse_page(page)
+        self._extract_products(products, plan, max_product_nb)
+
+        url_next_page = self._get_next_page_url(soup, plan)
+        if url_next_page is None:
+            raise(ValueError('Could not find the URL of the next page of results!'))
+        return url_next_page
+
+    def _extract_all_products(self, page):
+        """
+        Extract all the products of a given HTML page of Amazon results,
+        without looking for the URL of the next page
+        """
+        soup, plan, products = self._parse_page(page)
+        self._extract_products(
+            products, plan, len(self.product_dict_list) + len(products))
+
+    def _parse_page(self, page):
+        """
+        Parse the HTML `page`, and returns its soup, with the
+        `_ExtractionPlan` of its layout and the list of products found with it
+        """
+        start = time.perf_counter()
+        soup = BeautifulSoup(page, self.parser)
+        plan, products = self._select_products(soup)
+        self._record('parse_time', time.perf_counter() - start)
+        return soup, plan, products
+
+    def _select_products(self, soup):
+        """
+        Returns the `_ExtractionPlan` of the page layout and the list of
+        products found with it.
+        The layout found on the previous page of the same host is tried first
+        """
+        host = self.headers['Host']
+        cached_plan = self._layout_cache.get(host)
+        # the layouts may be replaced meanwhile (see `load_layouts`)
+        plan_list = list(_EXTRACTION_PLAN_LIST)
+        if cached_plan not in plan_list:
+            cached_plan = None
+        if cached_plan is not None:
+            plan_list = [cached_plan] + \
+                [plan for plan in plan_list if plan is not cached_plan]
 
         # shuffle through CSS selectors until we get a list of products
-        selector = 0
-        for css_selector_dict in _CSS_SELECTOR_LIST:
-            selector += 1
-            css_selector = css_selector_dict.get("product", "")
-            products = soup.select(css_selector)
+        for plan in plan_list:
+            products = plan.product.select(soup)
 
             if len(products) >= 1:
                 break
+        else:
+            # no layout matches : fall back on the last layout, as before
+            # the cache existed
+            plan = plan_list[-1]
 
+        if products and plan is cached_plan:
+            self._record('layout_hits')
+        else:
+            self._record('layout_misses')
+        if products:
+            self._layout_cache[host] = plan
+            self._record('layout_' + plan.name)
+
+        return plan, products
+
+    def _record_field_selector(self, field, index):
+        """
+        Remember that the selector at `index` gave the value of the `field`,
+        so that it is tried first on the next products of the host
+        """
+        preferred_selectors = self._field_selector_cache.setdefault(
+            self.headers['Host'], {})
+        if preferred_selectors.get(field) == index:
+            self._record('field_hits')
+        else:
+            self._record('field_misses')
+            preferred_selectors[field] = index
+
+    def _record_missing_field(self, field):
+        """ Count a product whose `field` could not be extracted """
+        logger.debug('Failed to extract %s!', field)
+        self._record('missing_' + field)
+
+    def _extract_products(self, products, plan, max_product_nb):
+        """
+        Extract the info of the `products` (soups) of a result page with the
+        `_ExtractionPlan` of the layout, and append them to the product list
+        """
+        start = time.perf_counter()
+        decimal_separator = _get_decimal_separator(self.headers['Host'])
         # For each product of the result page
         for product in products:
 
@@ -339,25 +773,30 @@ class Client(object):
 
             product_dict = {}
 
+            # find the elements of all the fields in a single walk
+            product_matches = plan.match(
+                product,
+                self._field_selector_cache.get(self.headers['Host'], {}),
+                decimal_separator)
+
             # extract title
-            product_dict['title'] = self._get_title(product)
+            product_dict['title'] = self._get_title(product_matches)
 
-            print('Extracting {}'.format(product_dict['title'][:80]))
+            logger.debug('Extracting %s', product_dict['title'][:80])
 
             # extract rating
-            product_dict['rating'] = self._get_rating(product)
+            product_dict['rating'] = self._get_rating(product_matches)
 
             # extract number of ratings
-            product_dict['review_nb'] = self._get_n_ratings(product)
+            product_dict['review_nb'] = self._get_n_ratings(product_matches)
 
             # Get image before url and asin
-            css_selector = css_selector_dict.get("img", "")
-            img_product_soup = product.select(css_selector)
-            if img_product_soup:
-                img_url = img_product_soup[0].get('src')
+            img_product_soup = product_matches['img'][0][1]
+            if img_product_soup is not None:
+                img_url = img_product_soup.get('src')
                 # Check if it is not a base64 formatted image
                 if "data:image/webp" in img_url:
-                    img_url = img_product_soup[0].get(
+                    img_url = img_product_soup.get(
                         'data-search-image-source-set',
                         '').split(' ')[0]
 
@@ -366,19 +805,16 @@ class Client(object):
 
                 product_dict['img'] = img_url
 
-
             # Extract ASIN and product URL
-            css_selector = css_selector_dict.get("url", "")
-
-            url_product_soup = product.select(css_selector)
+            url_product_soup = product_matches['url'][0][1]
 
             product_dict['url'] = ''
             product_dict['asin'] = ''
 
-            if url_product_soup:
+            if url_product_soup is not None:
                 url = urljoin(
                     self.base_url,
-                    url_product_soup[0].get('href'))
+                    url_product_soup.get('href'))
 
                 if 'slredirect' not in url:
                     product_dict['url'] = url.split("/ref=")[0]
@@ -386,60 +822,794 @@ class Client(object):
                     product_dict['asin'] = product_dict['url'].split("/")[-1]
 
             if not product_dict['url']:
-                print('  Failed to extract URL!')
+                self._record_missing_field('url')
 
             if not product_dict['asin']:
-                print('  Failed to extract ASIN!')
-
+                self._record_missing_field('asin')
 
             # Amazon has many prices associated with a given product
-            prices = self._get_prices(product)
+            prices = self._get_prices(product_matches)
             product_dict.update(prices)
 
             self.product_dict_list.append(product_dict)
+            self._record('products')
 
+        self._record('extract_time', time.perf_counter() - start)
 
-        css_selector = css_selector_dict.get("next_page_url")
-        url_next_page_soup = soup.select(css_selector)
-        if url_next_page_soup:
-            url_next_page = urljoin(
+    def _get_next_page_url(self, soup, plan):
+        """
+        Returns the URL of the next page of results, or None if not found
+        """
+        url_next_page_soup = plan.next_page_url.select_one(soup)
+        if url_next_page_soup is not None:
+            return urljoin(
                 self.base_url,
-                url_next_page_soup[0].get('href'))
-        else:
-            raise(ValueError('Could not find the URL of the next page of results!'))
-        return url_next_page
+                url_next_page_soup.get('href'))
+        return None
+
+    def _get_products(self, keywords="", search_url="", max_product_nb=100,
+                      pipeline=False, checkpoint=None, page_concurrency=1):
+        """
+        Get the products of the search, page after page.
+        With `pipeline`, the next page is downloaded while the products of the
+        current page are extracted.
+        With a `checkpoint` (`CrawlCheckpoint`), the search resumes from its
+        last completed page, and only the products not found before are kept.
+        With a `page_concurrency` above 1, the following pages are requested
+        concurrently once the first one gives the number of pages
+        """
+
+        if page_concurrency > 1:
+            if pipeline or checkpoint is not None:
+                raise ValueError('The page concurrency can not be used with '
+                                 'the pipeline or a checkpoint')
+            self._start_search()
+            if search_url == "":
+                search_url = self._get_search_url(keywords)
+            self._update_headers(search_url)
+            return self._get_products_fanout(
+                search_url, max_product_nb, page_concurrency)
+
+        if checkpoint is not None:
+            if pipeline:
+                raise ValueError(
+                    'The pipeline can not be used with a checkpoint')
+            self._start_search()
+            if search_url == "":
+                search_url = self._get_search_url(keywords)
+            self._update_headers(search_url)
+            return self._get_products_checkpointed(
+                search_url, max_product_nb, checkpoint)
+
+        if pipeline:
+            self._start_search()
+            if search_url == "":
+                search_url = self._get_search_url(keywords)
+            self._update_headers(search_url)
+            return self._get_products_pipelined(search_url, max_product_nb)
+
+        for _ in self._iter_pages(keywords=keywords,
+                                  search_url=search_url,
+                                  max_product_nb=max_product_nb):
+            pass
 
+        return self.product_dict_list
 
-    def _get_products(self, keywords="", search_url="", max_product_nb=100):
+    def _iter_pages(self, keywords="", search_url="", max_product_nb=100,
+                    keep_products=True):
+        """
+        Generator of the products (list of dicts) of each page of the search.
+        The next page is only downloaded when its products are requested.
+        Without `keep_products`, `product_dict_list` only holds the products
+        of the current page
+        """
 
+        self._start_search()
         if search_url == "":
             search_url = self._get_search_url(keywords)
         self._update_headers(search_url)
 
-        while len(self.product_dict_list) < max_product_nb:
+        product_nb = 0
+
+        while product_nb < max_product_nb:
 
             # get the html of the specified page
             page = self._get_page_html(search_url)
             self.html_pages.append(page)
 
-            # extract the needed products from the page and return the url of
-            # the next page
-            search_url = self._extract_page(page, max_product_nb=max_product_nb)
+            soup, plan, products = self._parse_page(page)
+            search_url = self._get_next_page_url(soup, plan)
+
+            if not keep_products:
+                self.product_dict_list = []
+            first = len(self.product_dict_list)
+            self._extract_products(
+                products, plan, first + max_product_nb - product_nb)
+            page_product_dict_list = self.product_dict_list[first:]
+            product_nb += len(page_product_dict_list)
+
+            yield page_product_dict_list
+
+            if product_nb < max_product_nb and search_url is None:
+                raise(ValueError('Could not find the URL of the next page of results!'))
+
+    def _get_products_pipelined(self, search_url, max_product_nb):
+        """
+        Same as `_get_products`, but the request of the next page is sent
+        (on a worker thread) as soon as its URL is known, before parsing the
+        products of the current page
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            next_page = executor.submit(self._get_page_html, search_url)
+            page_product_nb = 0  # Number of products on the previous page
+
+            while len(self.product_dict_list) < max_product_nb:
+
+                page = next_page.result()
+                next_page = None
+                self.html_pages.append(page)
+
+                # the pagination link is searched directly in the HTML, so
+                # that the request is sent before parsing the page (unless
+                # this page should be enough to reach `max_product_nb`)
+                search_url = _find_next_page_url(page, self.base_url)
+                if search_url is not None and \
+                        len(self.product_dict_list) + page_product_nb \
+                        < max_product_nb:
+                    next_page = executor.submit(
+                        self._get_page_html, search_url)
+
+                soup, plan, products = self._parse_page(page)
+                page_product_nb = len(products)
+                if search_url is None:
+                    search_url = self._get_next_page_url(soup, plan)
+
+                self._extract_products(products, plan, max_product_nb)
+
+                if len(self.product_dict_list) >= max_product_nb:
+                    break
+                if search_url is None:
+                    raise(ValueError('Could not find the URL of the next page of results!'))
+                if next_page is None:
+                    next_page = executor.submit(
+                        self._get_page_html, search_url)
+        finally:
+            # do not wait for a page that will not be used
+            executor.shutdown(wait=False)
+
+        return self.product_dict_list
+
+
+    def _get_products_fanout(self, search_url, max_product_nb,
+                             page_concurrency):
+        """
+        Same as `_get_products`, but the pages following the first one are
+        requested concurrently (up to `page_concurrency` at a time) with
+        their page number (from the page of `search_url`), as many as needed
+        to reach `max_product_nb`.
+        The products are extracted in the order of the pages.
+        If the search URL or the pagination of the first page is not
+        recognized, the next pages are downloaded one after the other
+        """
+        page = self._get_page_html(search_url)
+        self.html_pages.append(page)
+        soup, plan, products = self._parse_page(page)
+        first_search_url = search_url
+        search_url = self._get_next_page_url(soup, plan)
+        self._extract_products(products, plan, max_product_nb)
+
+        page_count = _get_page_count(soup)
+        products_per_page = len(products)
+        first_page_nb = _get_page_nb(first_search_url)
+        if page_count is None or products_per_page == 0 or \
+                first_page_nb is None or \
+                _get_page_url(first_search_url, 2) is None:
+            logger.info('Unknown pagination, downloading the pages one '
+                        'after the other')
+            self._record('fanout_fallbacks')
+            page_count = None
+            first_page_nb = 1
+
+        next_page_nb = first_page_nb + 1
+        executor = ThreadPoolExecutor(max_workers=page_concurrency)
+        next_pages = []
+        try:
+            while len(self.product_dict_list) < max_product_nb:
+
+                if page_count is None:
+                    # serial fallback, following the next page links
+                    if search_url is None:
+                        raise(ValueError('Could not find the URL of the next page of results!'))
+                    next_pages = [executor.submit(
+                        self._get_page_html, search_url)]
+                else:
+                    if next_page_nb > page_count:
+                        raise(ValueError('Could not find the URL of the next page of results!'))
+                    # number of pages still needed (if they are full)
+                    page_nb = -(-(max_product_nb - len(
+                        self.product_dict_list)) // products_per_page)
+                    last_page_nb = min(page_count, next_page_nb + page_nb - 1)
+                    next_pages = [
+                        executor.submit(self._get_page_html,
+                                        _get_page_url(first_search_url, n))
+                        for n in range(next_page_nb, last_page_nb + 1)]
+                    next_page_nb = last_page_nb + 1
+
+                for next_page in next_pages:
+                    if len(self.product_dict_list) >= max_product_nb:
+                        break
+                    page = next_page.result()
+                    self.html_pages.append(page)
+                    soup, plan, products = self._parse_page(page)
+                    search_url = self._get_next_page_url(soup, plan)
+                    self._extract_products(products, plan, max_product_nb)
+        finally:
+            # do not wait for the pages that will not be used
+            for next_page in next_pages:
+                next_page.cancel()
+            executor.shutdown(wait=False)
+
+        return self.product_dict_list
+
+    def _get_products_checkpointed(self, search_url, max_product_nb,
+                                   checkpoint):
+        """
+        Same as `_get_products`, but each completed page is recorded in the
+        `checkpoint`, with the ASINs of its products. The products already
+        found by the search (in this run or in the previous ones) are skipped
+        """
+        key = cache_key(search_url, self.headers['Host'])
+        state = checkpoint.get(key)
+        page_nb = 0  # Number of pages completed
+        if state is not None and not state.complete:
+            logger.info('Resuming the search after %d pages', state.page_nb)
+            self._record('resumed_pages', state.page_nb)
+            search_url = state.next_url
+            page_nb = state.page_nb
+
+        while len(self.product_dict_list) < max_product_nb:
+
+            page = self._get_page_html(search_url)
+            self.html_pages.append(page)
+
+            soup, plan, products = self._parse_page(page)
+            next_url = self._get_next_page_url(soup, plan)
+
+            first = len(self.product_dict_list)
+            self._extract_products(products, plan, first + len(products))
+            page_product_dict_list = self.product_dict_list[first:]
+            del self.product_dict_list[first:]
+
+            seen = checkpoint.filter_seen(
+                key, [product_dict['asin']
+                      for product_dict in page_product_dict_list])
+            new_asins = []
+            page_completed = True
+            for product_dict in page_product_dict_list:
+                asin = product_dict['asin']
+                if asin in seen:
+                    self._record('duplicates')
+                    continue
+                if len(self.product_dict_list) >= max_product_nb:
+                    page_completed = False
+                    break
+                if asin:
+                    seen.add(asin)
+                    new_asins.append(asin)
+                self.product_dict_list.append(product_dict)
+
+            if page_completed:
+                page_nb += 1
+            else:
+                # the end of the page will be downloaded again
+                next_url = search_url
+            checkpoint.save_page(key, next_url, page_nb, new_asins,
+                                 complete=next_url is None)
+            if next_url is None:
+                # last page of results
+                break
+            search_url = next_url
 
         return self.product_dict_list
 
 
-def _css_select(soup, css_selector):
+    def _enrich_products(self, product_dict_list,
+                         concurrency=_DEFAULT_ENRICH_CONCURRENCY):
+        """
+        Add the fields of the detail page of each product (brand,
+        availability, price, list_price and category) to its dict. The detail
+        pages are downloaded concurrently, up to `concurrency` at a time,
+        with the same session, user agents and retries as the result pages.
+        The fields are kept by ASIN, to not download a detail page again
+        """
+        host = self.headers['Host']
+        asins = []  # ASINs of the detail pages to download
+        for product_dict in product_dict_list:
+            asin = product_dict.get('asin')
+            if not asin:
+                continue
+            if (host, asin) in self._detail_cache:
+                self._record('detail_cache_hits')
+            elif asin not in asins:
+                asins.append(asin)
+
+        if asins:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for asin, details in zip(asins, executor.map(
+                        self._get_product_details, asins)):
+                    if details is not None:
+                        self._detail_cache[host, asin] = details
+
+        for product_dict in product_dict_list:
+            details = self._detail_cache.get(
+                (host, product_dict.get('asin')), {})
+            product_dict.update(
+                (field, details.get(field, float('nan')
+                                    if field in _DETAIL_PRICE_FIELDS else ""))
+                for field in _DETAIL_CSS_SELECTORS)
+        return product_dict_list
+
+    def _get_product_details(self, asin):
+        """
+        Download the detail page of the product and returns its fields, or
+        None if the page could not be downloaded
+        """
+        url = urljoin(self.base_url, "dp/" + asin)
+        try:
+            page = self._get_page_html(url)
+        except ValueError:
+            logger.info('Could not get the detail page of %s', asin)
+            self._record('detail_failures')
+            return None
+        self._record('detail_pages')
+        return self._extract_details(page)
+
+    def _extract_details(self, page):
+        """
+        Returns the fields of a product detail page
+        """
+        start = time.perf_counter()
+        soup = BeautifulSoup(page, self.parser)
+        decimal_separator = _get_decimal_separator(self.headers['Host'])
+        details = {}
+        for field, selector in _DETAIL_SELECTORS.items():
+            elements = selector.select(soup)
+            texts = [_get_text(element) for element in elements]
+            if field == 'category':
+                details[field] = " > ".join(text for text in texts if text)
+            elif field in _DETAIL_PRICE_FIELDS:
+                match = _search_price(texts[0]) if texts else None
+                details[field] = float('nan') if match is None else \
+                    _parse_number(match.group(1) or match.group(2),
+                                  decimal_separator)
+            elif field == 'brand' and texts:
+                match = _BRAND_REGEX.match(texts[0])
+                details[field] = texts[0] if match is None else \
+                    match.group(1) or match.group(2)
+            else:
+                details[field] = texts[0] if texts else ""
+        self._record('parse_time', time.perf_counter() - start)
+        return details
+
+
+class _ExtractionPlan(object):
+    """CSS selectors of a page layout, compiled once, and matched in a single
+    walk of each product.
+
+    With `layout_fields`, the title and review_nb selectors of the layout (if
+    any) are tried before the fallback ones (the built-in layouts only use
+    the fallback ones)"""
+
+    def __init__(self, name, css_selector_dict, layout_fields=False):
+        self.name = name
+        self.css_selector_dict = css_selector_dict
+        self.product = soupsieve.compile(css_selector_dict["product"])
+        self.next_page_url = soupsieve.compile(
+            css_selector_dict["next_page_url"])
+        # Selectors of each field, by order of preference
+        layout_selectors = css_selector_dict if layout_fields else {}
+        self.field_selectors = {
+            'title': _with_layout_selector(
+                layout_selectors, 'title', _TITLE_CSS_SELECTORS),
+            'review_nb': _with_layout_selector(
+                layout_selectors, 'review_nb', _N_RATINGS_CSS_SELECTORS),
+            'img': [css_selector_dict["img"]],
+            'url': [css_selector_dict["url"]],
+        }
+        # (field, index, tag name, compiled selector) of each selector
+        self._selectors = [
+            (field, index, _get_tag_name(selector),
+             soupsieve.compile(selector))
+            for field, selectors in self.field_selectors.items()
+            for index, selector in enumerate(selectors)]
+
+    def match(self, product, preferred_selectors={}, decimal_separator='.'):
+        """
+        Walk the `product` soup once, and return a dict with, for each field,
+        the `(index, element)` tuples of its selectors, with the first element
+        (in the document order) matched by the selector (or None), the first
+        match of `_RATING_REGEX` in the attributes and texts, and the texts
+        of prices (see `_search_price`).
+
+        `preferred_selectors` gives the index of the selector to try first for
+        some fields. When it matches a valid element (its numbers written with
+        the `decimal_separator`), the other selectors of the field are not
+        matched anymore.
+        >>> soup = BeautifulSoup('<ul id="resultItems"><li><a href="/dp/A1">\
+<img src="a.jpg"><h5><span>Title</span></h5>\
+<i title="4.5 out of 5"></i><span>$12.50</span></a></li></ul>', \
+_DEFAULT_BEAUTIFULSOUP_PARSER)
+        >>> plan = _ExtractionPlan("mobile", _CSS_SELECTORS_MOBILE)
+        >>> matches = plan.match(plan.product.select_one(soup))
+        >>> [(index, _get_text(element)) for index, element in matches['title']]
+        [(0, 'Title'), (1, ''), (2, '')]
+        >>> print(matches['url'][0][1]['href'], matches['img'][0][1]['src'])
+        /dp/A1 a.jpg
+        >>> print(matches['rating'].group(1), matches['prices'])
+        4.5 ['$12.50']
+        >>> matches = plan.match(plan.product.select_one(soup), {'title': 2})
+        >>> [index for index, element in matches['title']]
+        [2, 0, 1]
+        """
+        elements = {}
+        # selectors not matched yet
+        pending = self._selectors
+        rating = _search_attributes(_RATING_REGEX, product)
+        prices = []
+
+        for element in product.descendants:
+            if isinstance(element, Tag):
+                if pending:
+                    not_matched = []
+                    done_field = None
+                    for item in pending:
+                        # the tag name is checked first, as it is much
+                        # faster than matching the whole selector
+                        if item[2] in (None, element.name) and \
+                                item[3].match(element):
+                            elements[item[0], item[1]] = element
+                            if preferred_selectors.get(item[0]) == item[1] \
+                                    and _FIELD_VALIDATORS[item[0]](
+                                        element, decimal_separator):
+                                done_field = item[0]
+                        else:
+                            not_matched.append(item)
+                    if done_field is not None:
+                        not_matched = [item for item in not_matched
+                                       if item[0] != done_field]
+                    pending = not_matched
+                if rating is None:
+                    rating = _search_attributes(_RATING_REGEX, element)
+
+            elif isinstance(element, NavigableString):
+                if rating is None:
+                    rating = _RATING_REGEX.search(element)
+                if _search_price(element) is not None:
+                    prices.append(element)
+
+        matches = {}
+        for field, selectors in self.field_selectors.items():
+            indexes = list(range(len(selectors)))
+            preferred = preferred_selectors.get(field)
+            if preferred is not None:
+                indexes.remove(preferred)
+                indexes.insert(0, preferred)
+            matches[field] = [(index, elements.get((field, index)))
+                              for index in indexes]
+        matches['rating'] = rating
+        matches['prices'] = prices
+        return matches
+
+
+def _with_layout_selector(css_selector_dict, field, fallback_selectors):
+    """
+    Returns the selectors of a field : the one of the layout (if any), then
+    the fallback ones
+    >>> _with_layout_selector({'title': 'h6'}, 'title', ['h5', 'h2'])
+    ['h6', 'h5', 'h2']
+    >>> _with_layout_selector({'title': 'h5'}, 'title', ['h5', 'h2'])
+    ['h5', 'h2']
+    """
+    selector = css_selector_dict.get(field)
+    if selector is None:
+        return fallback_selectors
+    return [selector] + [fallback_selector
+                         for fallback_selector in fallback_selectors
+                         if fallback_selector != selector]
+
+
+def _get_text(element):
+    """
+    Returns the stripped text of the element, or an empty string if None
+    """
+    if element is None:
+        return ""
+    return element.text.strip()
+
+
+def _get_page_url(search_url, page_nb):
+    """
+    Returns the URL of the page `page_nb` of the search, or None if the shape
+    of the search URL is not known
+    >>> print(_get_page_url("https://www.amazon.com/s?k=python&ref=nb_sb", 3))
+    https://www.amazon.com/s?k=python&page=3
+    >>> print(_get_page_url("https://www.amazon.com/s?k=python&page=2", 4))
+    https://www.amazon.com/s?k=python&page=4
+    >>> print(_get_page_url("https://www.amazon.com/s/\
+ref=nb_sb_noss?url=search-alias%3Daps&field-keywords=python", 2))
+    None
+    """
+    parts = urlsplit(search_url)
+    query = [(name, value) for name, value in parse_qsl(parts.query)
+             if name not in ('page', 'ref')]
+    if parts.path.rstrip('/') != '/s' or 'k' not in dict(query):
+        return None
+    query.append(('page', str(page_nb)))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path,
+                       urlencode(query), ''))
+
+
+def _get_page_nb(search_url):
+    """
+    Returns the page number of the search URL (1 if not given), or None if it
+    is not a number
+    >>> _get_page_nb("https://www.amazon.com/s?k=python&page=3")
+    3
+    >>> _get_page_nb("https://www.amazon.com/s?k=python")
+    1
+    """
+    page_nb = dict(parse_qsl(urlsplit(search_url).query)).get('page', '1')
+    return int(page_nb) if page_nb.isdigit() else None
+
+
+def _get_page_count(soup):
+    """
+    Returns the number of pages of results, found in the pagination of the
+    page, or None
+    >>> _get_page_count(BeautifulSoup('<ul class="a-pagination">\
+<li class="a-selected">1</li><li class="a-normal">2</li>\
+<li class="a-disabled">...</li><li class="a-disabled">20</li>\
+<li class="a-last">Next</li></ul>', _DEFAULT_BEAUTIFULSOUP_PARSER))
+    20
+    >>> print(_get_page_count(BeautifulSoup('<p>1</p>', \
+_DEFAULT_BEAUTIFULSOUP_PARSER)))
+    None
+    """
+    page_nbs = [int(text) for text in map(
+        _get_text, _PAGINATION_SELECTOR.select(soup)) if text.isdigit()]
+    return max(page_nbs) if page_nbs else None
+
+
+def _search_price(text):
+    """
+    Returns the match of the price of the text (`_PRICE_REGEX`, or
+    `_WHOLE_PRICE_REGEX` if the whole text is a price without cents), or None
+    >>> print(_search_price("$1,234.56").group(1))
+    1,234.56
+    >>> print(_search_price(" ¥1,234 ").group(1))
+    1,234
+    >>> print(_search_price("FREE Shipping on orders over $25 shipped by Amazon"))
+    None
+    """
+    return _PRICE_REGEX.search(text) or _WHOLE_PRICE_REGEX.fullmatch(text)
+
+
+def _get_decimal_separator(host):
     """
-    Returns the content of the element pointed by the CSS selector, or an empty
-    string if not found
+    Returns the decimal separator of the numbers of the Amazon host
+    >>> print(_get_decimal_separator("www.amazon.com"))
+    .
+    >>> print(_get_decimal_separator("www.amazon.fr"))
+    ,
     """
-    selection = soup.select(css_selector)
-    retour = ""
-    if len(selection) > 0:
-        if hasattr(selection[0], 'text'):
-            retour = selection[0].text.strip()
-    return retour
+    if host.endswith(_DECIMAL_COMMA_DOMAINS):
+        return ','
+    return '.'
+
+
+def _parse_number(text, decimal_separator='.'):
+    """
+    Returns the number written with the `decimal_separator`, as a float
+    >>> _parse_number("1,234.56")
+    1234.56
+    >>> _parse_number("1\u202f234,56", ","), _parse_number("1.234,56", ",")
+    (1234.56, 1234.56)
+    >>> _parse_number("3,980")
+    3980.0
+    """
+    text = _THOUSANDS_SEPARATORS_REGEX[decimal_separator].sub('', text)
+    return float(text.replace(',', '.'))
+
+
+def _remove_separators(count, decimal_separator='.'):
+    """
+    Returns the text of a count without the thousands separators of the
+    numbers written with the `decimal_separator`
+    >>> print(_remove_separators("1,102"), _remove_separators("1\u00a0102"))
+    1102 1102
+    >>> print(_remove_separators("1.102", ","), _remove_separators("4.5"))
+    1102 4.5
+    """
+    return _THOUSANDS_SEPARATORS_REGEX[decimal_separator].sub('', count)
+
+
+def _get_conditional_headers(cached_response):
+    """
+    Returns the headers to revalidate a cached response
+    >>> from amazonscraper.cache import CachedResponse
+    >>> _get_conditional_headers(CachedResponse("", '"v1"', None, 0))
+    {'If-None-Match': '"v1"'}
+    """
+    headers = {}
+    if cached_response.etag:
+        headers['If-None-Match'] = cached_response.etag
+    if cached_response.last_modified:
+        headers['If-Modified-Since'] = cached_response.last_modified
+    return headers
+
+
+def _get_beautifulsoup_parser(parser):
+    """
+    Returns the BeautifulSoup parser to use : `parser` if it is installed,
+    else the default pure-Python "html.parser"
+    >>> print(_get_beautifulsoup_parser(None))
+    html.parser
+    >>> print(_get_beautifulsoup_parser("html.parser"))
+    html.parser
+    >>> _get_beautifulsoup_parser("selectolax")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown parser selectolax (choose among html.parser, lxml, \
+html5lib)
+    """
+    if parser is None:
+        return _DEFAULT_BEAUTIFULSOUP_PARSER
+    if parser not in _BEAUTIFULSOUP_PARSER_LIST:
+        raise ValueError('Unknown parser {} (choose among {})'.format(
+            parser, ', '.join(_BEAUTIFULSOUP_PARSER_LIST)))
+    if builder_registry.lookup(parser) is None:
+        logger.warning('Parser %s is not installed, using %s',
+                       parser, _DEFAULT_BEAUTIFULSOUP_PARSER)
+        return _DEFAULT_BEAUTIFULSOUP_PARSER
+    return parser
+
+
+def _get_tag_name(css_selector):
+    """
+    Returns the tag name of the elements matched by the selector, or None if
+    it is not specified
+    >>> print(_get_tag_name("div.a-row > a.a-link-normal[href]"))
+    a
+    >>> print(_get_tag_name("div span.a-size-small"))
+    span
+    >>> print(_get_tag_name("div > .a-size-small"))
+    None
+    """
+    last_compound = re.split(r'[\s>+~]+', css_selector.strip())[-1]
+    tag_name = re.match(r'[a-zA-Z][a-zA-Z0-9-]*', last_compound)
+    if tag_name is None:
+        return None
+    return tag_name.group(0).lower()
+
+
+def _search_attributes(regex, tag):
+    """
+    Returns the first match of `regex` in the attribute values of `tag`
+    """
+    for value in tag.attrs.values():
+        if isinstance(value, list):
+            value = " ".join(value)
+        match = regex.search(value)
+        if match:
+            return match
+    return None
+
+
+def _find_next_page_url(page, base_url):
+    """
+    Returns the URL of the next page of results, searched in the HTML `page`
+    without parsing it, or None if not found
+    >>> print(_find_next_page_url('<ul class="a-pagination">\
+<li class="a-last"><a href="/s?k=python&amp;page=2">Next</a></li></ul>',\
+"https://www.amazon.com/"))
+    https://www.amazon.com/s?k=python&page=2
+    >>> print(_find_next_page_url('<a class="pagnNext" id="pagnNextLink" \
+href="/s?k=python&amp;page=3">Next</a>', "https://www.amazon.com/"))
+    https://www.amazon.com/s?k=python&page=3
+    >>> print(_find_next_page_url('<li class="a-last">Next</li>',\
+"https://www.amazon.com/"))
+    None
+    """
+    match = _NEXT_PAGE_LINK_REGEX.search(page)
+    if match is None:
+        return None
+    href = _HREF_REGEX.search(match.group(1) or match.group(2))
+    if href is None:
+        return None
+    return urljoin(base_url, unescape(href.group(1)))
+
+
+def _build_search_url(base_url, keywords):
+    """ Returns the search URL of the keywords on the Amazon domain """
+    return urljoin(base_url, ("s?k=%s" % (keywords)))
+
+
+def load_layouts(path):
+    """ Load the result page layouts of a JSON file (or YAML, if PyYAML is
+    installed), to fix the selectors of a layout changed by Amazon without a
+    new release. The file has a list of layouts, with their name and their
+    CSS selectors :
+
+        {"layouts": [{"name": "desktop_3",
+                      "selectors": {"product": "...", "url": "...", ...}}]}
+
+    The selectors `product`, `url`, `img` and `next_page_url` are required.
+    `title` and `review_nb` are optional : they are tried before the
+    fallback selectors of these fields. The other keys are ignored, with a
+    warning (ex : `rating`, as the rating is found by its text).
+
+    A layout replaces the one with the same name, or is added after the
+    others. The selectors are compiled before any layout is replaced, so that
+    an invalid file leaves the layouts unchanged (ValueError). Returns the
+    names of the layouts loaded. The clients use them from their next page
+    """
+    with open(path, encoding='utf-8') as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('YAML layouts require PyYAML \
+(pip install pyyaml)')
+            content = yaml.safe_load(f)
+        else:
+            content = json.load(f)
+
+    layout_list = content.get('layouts') \
+        if isinstance(content, dict) else None
+    if not isinstance(layout_list, list):
+        raise ValueError('{}: no "layouts" list'.format(path))
+    plan_list = []
+    for layout in layout_list:
+        name = layout.get('name') if isinstance(layout, dict) else None
+        selectors = layout.get('selectors') if name else None
+        if not isinstance(selectors, dict):
+            raise ValueError(
+                '{}: each layout needs a "name" and "selectors"'.format(path))
+        missing = [key for key in _REQUIRED_LAYOUT_SELECTORS
+                   if key not in selectors]
+        if missing:
+            raise ValueError('{}: the layout "{}" has no {} selector'.format(
+                path, name, ', '.join(missing)))
+        unknown = [key for key in selectors
+                   if key not in _REQUIRED_LAYOUT_SELECTORS +
+                   _OPTIONAL_LAYOUT_SELECTORS]
+        if unknown:
+            logger.warning(
+                '%s: unknown selectors ignored in the layout "%s": %s '
+                '(accepted : %s)', path, name, ', '.join(unknown),
+                ', '.join(_REQUIRED_LAYOUT_SELECTORS +
+                          _OPTIONAL_LAYOUT_SELECTORS))
+        try:
+            plan_list.append(_ExtractionPlan(name, selectors,
+                                             layout_fields=True))
+        except soupsieve.SelectorSyntaxError as e:
+            raise ValueError('{}: invalid selector in the layout "{}": {}'
+                             .format(path, name, e))
+
+    new_plan_list = list(_EXTRACTION_PLAN_LIST)
+    for plan in plan_list:
+        names = [known_plan.name for known_plan in new_plan_list]
+        if plan.name in names:
+            new_plan_list[names.index(plan.name)] = plan
+        else:
+            new_plan_list.append(plan)
+    # replaced at once, for the clients running in other threads
+    _EXTRACTION_PLAN_LIST[:] = new_plan_list
+    logger.info('Layouts loaded from %s: %s', path,
+                ', '.join(plan.name for plan in plan_list))
+    return [plan.name for plan in plan_list]
+
 
 def _get_high_res_img_url(img_url):
     """ Returns a modified url pointing to the high resolution version of
@@ -455,3 +1625,21 @@ images/I/51F48HFHq6L.jpg
     """
     high_res_url = img_url.split("._")[0] + ".jpg"
     return high_res_url
+
+
+_EXTRACTION_PLAN_LIST = [
+    _ExtractionPlan(name, css_selector_dict)
+    for name, css_selector_dict in zip(_LAYOUT_NAME_LIST, _CSS_SELECTOR_LIST)]
+
+_DETAIL_SELECTORS = {
+    field: soupsieve.compile(selector)
+    for field, selector in _DETAIL_CSS_SELECTORS.items()}
+
+# Functions checking that the element matched for a field gives a value
+_FIELD_VALIDATORS = {
+    'title': lambda element, decimal_separator: _get_text(element) != "",
+    'review_nb': lambda element, decimal_separator: _remove_separators(
+        _get_text(element), decimal_separator).isdigit(),
+    'img': lambda element, decimal_separator: True,
+    'url': lambda element, decimal_separator: True,
+}
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Module to share the SQLite databases (cache, checkpoint, queue, snapshots)
+between threads
+"""
+
+from contextlib import contextmanager
+import sqlite3
+import threading
+
+# Paths of the databases that only exist in their connection
+_PRIVATE_PATHS = (':memory:', '')
+
+
+class Database(object):
+    """SQLite database of the file `path`, that may be shared between threads
+    and processes of a machine (the file is in WAL mode, which does not work
+    through a network file system). SQLite connections can not be shared
+    between threads, so each thread has its own connection. An in-memory
+    database (":memory:") only exists in its connection : it has a single
+    connection, used by one thread at a time.
+
+    `schema` is the list of the statements creating the tables, run by each
+    new connection. The other arguments are those of `sqlite3.connect` """
+
+    def __init__(self, path, schema, **connect_kwargs):
+        """
+        >>> database = Database(":memory:", [
+        ...     'CREATE TABLE IF NOT EXISTS items (name TEXT)'])
+        >>> def insert():
+        ...     with database.connect() as connection, connection:
+        ...         connection.execute("INSERT INTO items VALUES ('a')")
+        >>> thread = threading.Thread(target=insert)
+        >>> thread.start(); thread.join()
+        >>> with database.connect() as connection:
+        ...     connection.execute('SELECT name FROM items').fetchall()
+        [('a',)]
+        """
+        self.path = path
+        self.schema = schema
+        self.connect_kwargs = dict(connect_kwargs, timeout=30)
+        if path in _PRIVATE_PATHS:
+            self._lock = threading.RLock()
+            self._shared_connection = self._new_connection(
+                check_same_thread=False)
+        else:
+            self._lock = None
+            self._local = threading.local()
+            # create the tables (and check the file) now
+            self._thread_connection()
+
+    def _new_connection(self, **connect_kwargs):
+        connection = sqlite3.connect(
+            self.path, **dict(self.connect_kwargs, **connect_kwargs))
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in self.schema:
+            connection.execute(statement)
+        if connection.in_transaction:
+            connection.commit()
+        return connection
+
+    def _thread_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._new_connection()
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def connect(self):
+        """ Returns the connection of the thread, that only this thread uses
+        until the end of the `with` block """
+        if self._lock is None:
+            yield self._thread_connection()
+        else:
+            with self._lock:
+                yield self._shared_connection
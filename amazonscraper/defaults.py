@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+Default settings of the clients, importable without importing the clients
+(and their dependencies : requests, BeautifulSoup...)
+"""
+
+_BASE_URL = "https://www.amazon.com/"
+
+# Default number of detail pages downloaded at the same time
+_DEFAULT_ENRICH_CONCURRENCY = 4
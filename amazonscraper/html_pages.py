@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Module to keep the HTML pages downloaded by a client, with a bounded memory
+"""
+
+from collections import deque
+import gzip
+import os
+import tempfile
+
+
+class HtmlPages(object):
+    """List of the HTML pages of a search, keeping only the last
+    `max_pages_in_memory` pages in memory (all of them if None). The older
+    pages are compressed to `spill_dir` if specified, else they are dropped
+    """
+
+    def __init__(self, max_pages_in_memory=1, spill_dir=None):
+        """
+        >>> pages = HtmlPages(max_pages_in_memory=2)
+        >>> for page in ["<p>1</p>", "<p>2</p>", "<p>3</p>"]:
+        ...     pages.append(page)
+        >>> list(pages)
+        ['<p>2</p>', '<p>3</p>']
+        >>> print(pages[-1])
+        <p>3</p>
+        >>> pages[-2:]
+        ['<p>2</p>', '<p>3</p>']
+        >>> print(HtmlPages(max_pages_in_memory=0).last)
+        <BLANKLINE>
+        """
+        self.max_pages_in_memory = max_pages_in_memory
+        self.spill_dir = spill_dir
+        self._pages = deque()
+        self._spilled_files = []  # Paths of the pages written to disk
+
+    def append(self, page):
+        """ Add a page, and evict the oldest one from memory if needed """
+        if self.max_pages_in_memory == 0:
+            if self.spill_dir is not None:
+                self._spill(page)
+            return
+        self._pages.append(page)
+        if self.max_pages_in_memory is not None and \
+                len(self._pages) > self.max_pages_in_memory:
+            oldest_page = self._pages.popleft()
+            if self.spill_dir is not None:
+                self._spill(oldest_page)
+
+    def _spill(self, page):
+        """ Write the page, compressed, in the spill directory """
+        os.makedirs(self.spill_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(
+            prefix='page_', suffix='.html.gz', dir=self.spill_dir)
+        os.close(fd)
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write(page)
+        self._spilled_files.append(path)
+
+    def _read_spilled(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return f.read()
+
+    @property
+    def last(self):
+        """ Last page kept, or an empty string if there is none """
+        if len(self) == 0:
+            return ""
+        return self[-1]
+
+    def __len__(self):
+        return len(self._spilled_files) + len(self._pages)
+
+    def __getitem__(self, index):
+        """ Method to access the object as a list (ex : pages[-1], pages[-2:]),
+        only reading the spilled pages of the index """
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('page index out of range')
+        if index < len(self._spilled_files):
+            return self._read_spilled(self._spilled_files[index])
+        return self._pages[index - len(self._spilled_files)]
+
+    def __iter__(self):
+        for path in self._spilled_files:
+            yield self._read_spilled(path)
+        for page in list(self._pages):
+            yield page
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Module to share searches between worker processes, through a queue of
+result pages to download
+"""
+
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import json
+import os
+import socket
+import time
+from urllib.parse import urlsplit
+from amazonscraper.client import Client, load_layouts, logger, \
+    _build_search_url
+from amazonscraper.database import Database
+from amazonscraper.defaults import _BASE_URL
+
+# `search` is the keywords (or the URL) of the search, `url` the result page
+# to download, `offset` the number of products found on the previous pages,
+# and `remaining` the number of products still wanted. `owner` and `attempts`
+# identify the lease of the job
+Job = namedtuple('Job', ['id', 'search', 'url', 'page_nb', 'offset',
+                         'remaining', 'owner', 'attempts'])
+
+
+class CrawlQueue(object):
+    """SQLite queue of the result pages to download, shared by the worker
+    processes (see `run_worker`) of a machine. The SQLite file is written in
+    WAL mode, which needs the shared memory of a single host : it must not be
+    shared between machines through a network file system.
+
+    A worker leases a page for `lease_time` seconds : if it crashes, the page
+    is leased again by another worker once the lease has expired (up to
+    `max_attempts` times). At most `max_requests_per_host` pages of a same
+    Amazon host are leased at the same time, by all the workers.
+
+    An in-memory queue (":memory:") is only shared by the threads of the
+    process.
+
+    Another queue backend (ex : Redis) can be used by the workers, to share
+    the searches between machines, as long as it provides the `lease`,
+    `complete`, `fail` and `is_finished` methods """
+
+    def __init__(self, path, lease_time=300, max_requests_per_host=2,
+                 max_attempts=3):
+        """
+        >>> queue = CrawlQueue(":memory:", max_requests_per_host=1)
+        >>> queue.put("python", max_product_nb=10)
+        1
+        >>> queue.put("scraping")
+        2
+        >>> job = queue.lease("worker-1")
+        >>> print(job.search, job.url, job.remaining)
+        python https://www.amazon.com/s?k=python 10
+        >>> queue.lease("worker-2") is None  # same host
+        True
+        >>> queue.complete(job, [{'title': 'Book', 'asin': 'A1'}],
+        ...                "https://www.amazon.com/s?k=python&page=2")
+        True
+        >>> print(queue.lease("worker-2").url)
+        https://www.amazon.com/s?k=scraping
+        >>> queue.counts()
+        {'done': 1, 'leased': 1, 'pending': 1}
+        >>> list(queue.results())
+        [('python', {'title': 'Book', 'asin': 'A1'})]
+        """
+        self.path = path
+        self.lease_time = lease_time
+        self.max_requests_per_host = max_requests_per_host
+        self.max_attempts = max_attempts
+        # the transactions are started explicitly (see `_transaction`)
+        self._database = Database(path, [
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY, search TEXT, url TEXT, host TEXT, '
+            'page_nb INTEGER, offset INTEGER, remaining INTEGER, '
+            'state TEXT, owner TEXT, lease_expires REAL, '
+            'attempts INTEGER, error TEXT, updated_at REAL)',
+            'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, host)',
+            'CREATE TABLE IF NOT EXISTS products ('
+            'search TEXT, position INTEGER, product TEXT, '
+            'PRIMARY KEY (search, position)) WITHOUT ROWID'],
+            isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        """ Run the statements in a transaction holding the write lock of the
+        database from its start, so that two workers can not lease the same
+        job """
+        with self._database.connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def put(self, keywords="", search_url="", max_product_nb=100,
+            base_url=_BASE_URL):
+        """ Add a search (its first result page), and returns its job id """
+        search = keywords
+        if search_url == "":
+            search_url = _build_search_url(base_url, keywords)
+        if search == "":
+            search = search_url
+        with self._transaction() as connection:
+            return connection.execute(
+                'INSERT INTO jobs (search, url, host, page_nb, offset, '
+                'remaining, state, attempts, updated_at) '
+                "VALUES (?, ?, ?, 1, 0, ?, 'pending', 0, ?)",
+                (search, search_url, urlsplit(search_url).netloc.lower(),
+                 max_product_nb, time.time())).lastrowid
+
+    def lease(self, owner):
+        """ Returns the next `Job` to do, leased by the worker `owner`, or
+        None if there is no job available (all the jobs are done, leased, or
+        their hosts have reached `max_requests_per_host`) """
+        now = time.time()
+        with self._transaction() as connection:
+            # the jobs of the crashed workers
+            connection.execute(
+                "UPDATE jobs SET state = 'failed', error = 'lease expired', "
+                "updated_at = ? WHERE state = 'leased' AND lease_expires < ? "
+                'AND attempts >= ?', (now, now, self.max_attempts))
+            row = connection.execute(
+                'SELECT id, search, url, page_nb, offset, remaining, '
+                'attempts FROM jobs '
+                "WHERE (state = 'pending' OR (state = 'leased' AND "
+                'lease_expires < ?)) AND host NOT IN ('
+                "SELECT host FROM jobs WHERE state = 'leased' AND "
+                'lease_expires >= ? GROUP BY host HAVING COUNT(*) >= ?) '
+                'ORDER BY id LIMIT 1',
+                (now, now, self.max_requests_per_host)).fetchone()
+            if row is None:
+                return None
+            attempts = row[6] + 1
+            connection.execute(
+                "UPDATE jobs SET state = 'leased', owner = ?, "
+                'lease_expires = ?, attempts = ?, updated_at = ? '
+                'WHERE id = ?',
+                (owner, now + self.lease_time, attempts, now, row[0]))
+        return Job(*row[:6], owner=owner, attempts=attempts)
+
+    def _check_lease(self, connection, job):
+        """ Returns True if the job is still leased by its worker (its lease
+        may have expired and been given to another worker) """
+        return connection.execute(
+            "SELECT 1 FROM jobs WHERE id = ? AND state = 'leased' AND "
+            'owner = ? AND attempts = ?',
+            (job.id, job.owner, job.attempts)).fetchone() is not None
+
+    def complete(self, job, product_dict_list, next_url):
+        """ Record the products of the page of the job and add the job of the
+        next page (if more products are wanted), in a single transaction.
+        Returns False, without recording anything, if the job is not leased
+        by its worker anymore """
+        remaining = job.remaining - len(product_dict_list)
+        now = time.time()
+        with self._transaction() as connection:
+            if not self._check_lease(connection, job):
+                return False
+            connection.executemany(
+                'INSERT OR REPLACE INTO products VALUES (?, ?, ?)',
+                [(job.search, job.offset + index, json.dumps(product_dict))
+                 for index, product_dict in enumerate(product_dict_list)])
+            connection.execute(
+                "UPDATE jobs SET state = 'done', updated_at = ? WHERE id = ?",
+                (now, job.id))
+            # a page without products ends the search (ex : unknown layout)
+            if next_url is not None and product_dict_list and remaining > 0:
+                connection.execute(
+                    'INSERT INTO jobs (search, url, host, page_nb, offset, '
+                    'remaining, state, attempts, updated_at) '
+                    "VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, ?)",
+                    (job.search, next_url,
+                     urlsplit(next_url).netloc.lower(), job.page_nb + 1,
+                     job.offset + len(product_dict_list), remaining, now))
+        return True
+
+    def fail(self, job, error):
+        """ Release the job after an error : it will be leased again, unless
+        it has reached `max_attempts` """
+        with self._transaction() as connection:
+            if not self._check_lease(connection, job):
+                return
+            connection.execute(
+                'UPDATE jobs SET state = ?, error = ?, updated_at = ? '
+                'WHERE id = ?',
+                ("failed" if job.attempts >= self.max_attempts
+                 else "pending", error, time.time(), job.id))
+
+    def is_finished(self):
+        """ Returns True if there is no job pending or leased """
+        with self._database.connect() as connection:
+            return connection.execute(
+                "SELECT 1 FROM jobs WHERE state IN ('pending', 'leased') "
+                'LIMIT 1').fetchone() is None
+
+    def counts(self):
+        """ Returns the number of jobs of each state (pending, leased, done
+        and failed) """
+        with self._database.connect() as connection:
+            return dict(connection.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state '
+                'ORDER BY state'))
+
+    def results(self):
+        """ Generator of the `(search, product dict)` tuples of the products
+        found, by search, in the order of the result pages """
+        with self._database.connect() as connection:
+            cursor = connection.execute(
+                'SELECT search, product FROM products '
+                'ORDER BY search, position')
+        while True:
+            # the connection is not kept between the batches of rows
+            with self._database.connect():
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for search, product in rows:
+                yield search, json.loads(product)
+
+
+def run_worker(queue, owner=None, parser=None, rate_limiter=None,
+               poll_interval=1., max_jobs=None):
+    """ Download and extract the pages of the `queue` with a client, until
+    all the jobs of the queue are done (or after `max_jobs` jobs). Returns the
+    statistics of the client, for all the jobs
+
+    `owner` is the name of the worker in the leases (host name and process id
+    if None). When no job is available, the queue is polled every
+    `poll_interval` seconds.
+    `parser` and `rate_limiter` : see `amazonscraper.search` """
+    if owner is None:
+        owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+    amz = Client(parser=parser, rate_limiter=rate_limiter)
+    stats = Counter()
+    job_nb = 0
+
+    while max_jobs is None or job_nb < max_jobs:
+        job = queue.lease(owner)
+        if job is None:
+            if queue.is_finished():
+                break
+            time.sleep(poll_interval)
+            continue
+        job_nb += 1
+
+        amz._start_search()
+        amz._update_headers(job.url)
+        try:
+            page = amz._get_page_html(job.url)
+            soup, plan, products = amz._parse_page(page)
+            next_url = amz._get_next_page_url(soup, plan)
+            amz._extract_products(products, plan, job.remaining)
+        except Exception as e:
+            logger.warning('Job %d (%s, page %d) failed: %s',
+                           job.id, job.search, job.page_nb, e)
+            queue.fail(job, str(e))
+            amz._record('failed_jobs')
+        else:
+            if not queue.complete(job, amz.product_dict_list, next_url):
+                logger.warning('Job %d (%s, page %d): lease lost',
+                               job.id, job.search, job.page_nb)
+                amz._record('lost_leases')
+        stats.update(amz.stats)
+        stats['jobs'] += 1
+
+    return stats
+
+
+def _run_worker_process(path, lease_time, max_requests_per_host, parser):
+    queue = CrawlQueue(path, lease_time=lease_time,
+                       max_requests_per_host=max_requests_per_host)
+    return run_worker(queue, parser=parser)
+
+
+def run_workers(path, processes=None, lease_time=300,
+                max_requests_per_host=2, parser=None, layouts=None):
+    """ Run `processes` workers (the number of CPUs by default) on the queue
+    of the SQLite file `path`, until all its jobs are done, and returns the
+    sum of their statistics
+
+    `layouts` is a file of layouts loaded by the workers (see
+    `load_layouts`), as they do not share the layouts loaded by the current
+    process """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    stats = Counter()
+    with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=None if layouts is None else load_layouts,
+            initargs=(layouts,)) as executor:
+        for worker_stats in executor.map(
+                _run_worker_process, [path] * processes,
+                [lease_time] * processes, [max_requests_per_host] * processes,
+                [parser] * processes):
+            stats.update(worker_stats)
+    return stats
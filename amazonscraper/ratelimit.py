@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Module to limit the rate of the requests sent to the Amazon servers
+"""
+
+import random
+import threading
+import time
+
+# Base delay (seconds) before retrying, by type of failure
+_BACKOFF_BASE_DELAYS = {
+    'robot_check': 4.,     # CAPTCHA : Amazon detected the scraping
+    'not_satisfied': 2.,   # CloudFront error page
+    'server_error': 2.,    # 5xx status code (ex : 503 when throttled)
+    'sign_in': 1.,         # sign-in suggestion page
+    'http_error': 1.,      # other status codes
+    'ssl': .5,             # "SSLError bad handshake"
+}
+_MAX_BACKOFF_DELAY = 60.
+
+# Failures meaning that the requests are sent too fast
+_THROTTLING_FAILURES = frozenset(
+    ['robot_check', 'not_satisfied', 'server_error'])
+
+
+def get_backoff_delay(failure, attempt):
+    """ Returns the delay (seconds) to wait before retrying after the
+    `attempt`-th failed request (starting at 1) : exponential backoff, from
+    the base delay of the failure type, with full jitter
+    >>> 0 <= get_backoff_delay('ssl', 1) <= .5
+    True
+    >>> 0 <= get_backoff_delay('robot_check', 3) <= 16
+    True
+    >>> get_backoff_delay('robot_check', 100) <= _MAX_BACKOFF_DELAY
+    True
+    """
+    base_delay = _BACKOFF_BASE_DELAYS.get(failure, 1.)
+    max_delay = min(_MAX_BACKOFF_DELAY,
+                    base_delay * 2 ** min(attempt - 1, 32))
+    return random.uniform(0, max_delay)
+
+
+class TokenBucket(object):
+    """Allow `rate` requests per second on average, with bursts of up to
+    `capacity` requests"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token, and return the delay (seconds) to wait before
+        using it. The tokens taken in advance delay the next reservations
+        >>> bucket = TokenBucket(rate=2, capacity=1)
+        >>> bucket.reserve()
+        0
+        >>> 0.4 < bucket.reserve() <= 0.5
+        True
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """ Wait until a token is available, and take it """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class HostRateLimiter(object):
+    """Token buckets of the Amazon hosts, shared by the clients running
+    concurrently. The rate of a host is halved (down to `min_rate`) when its
+    pages show throttling (CAPTCHA, 503...), and increased again by steps of
+    `rate / 10` (up to `max_rate`) after each valid page"""
+
+    def __init__(self, rate=1., capacity=1, min_rate=None, max_rate=None):
+        """
+        >>> limiter = HostRateLimiter(rate=2)
+        >>> limiter.on_failure('www.amazon.com', 'robot_check')
+        >>> limiter.get_rate('www.amazon.com')
+        1.0
+        >>> limiter.on_failure('www.amazon.com', 'ssl')
+        >>> limiter.on_success('www.amazon.com')
+        >>> limiter.get_rate('www.amazon.com')
+        1.2
+        >>> limiter.get_rate('www.amazon.fr')
+        2
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate if min_rate is not None else rate / 16.
+        self.max_rate = max_rate if max_rate is not None else rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, host):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self._buckets[host] = bucket
+        return bucket
+
+    def get_rate(self, host):
+        """ Returns the current rate (requests per second) of the host """
+        return self._get_bucket(host).rate
+
+    def reserve(self, host):
+        """ Take a token of the host, and return the delay to wait before
+        sending the request (for non-blocking clients) """
+        return self._get_bucket(host).reserve()
+
+    def acquire(self, host):
+        """ Wait until a request can be sent to the host """
+        self._get_bucket(host).acquire()
+
+    def on_success(self, host):
+        """ Increase the rate of the host after a valid page """
+        bucket = self._get_bucket(host)
+        with bucket._lock:
+            bucket.rate = min(self.max_rate, bucket.rate + self.rate / 10.)
+
+    def on_failure(self, host, failure):
+        """ Decrease the rate of the host if the failure shows throttling """
+        if failure not in _THROTTLING_FAILURES:
+            return
+        bucket = self._get_bucket(host)
+        with bucket._lock:
+            bucket.rate = max(self.min_rate, bucket.rate / 2.)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Module to keep the last results of the searches, to get only the products
+that changed since then
+"""
+
+import math
+import time
+from amazonscraper import Product
+from amazonscraper.database import Database
+
+# Fields compared between two results of a search (`rank` is the position of
+# the product in the results, starting at 1)
+_TRACKED_FIELDS = ('rank', 'prices_main', 'rating', 'review_nb')
+# Fields kept to describe the dropped products
+_DESCRIPTION_FIELDS = ('title', 'url', 'img')
+# Columns added to the changed products : type of change (new, dropped or
+# changed), fields changed, and previous values of the tracked fields
+DIFF_COLUMNS = ['change', 'changed_fields', 'rank'] + [
+    'previous_' + field for field in _TRACKED_FIELDS]
+
+
+def _stored_value(value):
+    """ Returns the value stored in SQLite (NULL if missing) """
+    if value.__class__ is float and math.isnan(value):
+        return None
+    return value
+
+
+class SnapshotStore(object):
+    """SQLite store of the last results of each search : the rank, price,
+    rating and number of reviews of each product (by ASIN). It may be shared
+    between threads and processes.
+
+    `update` compares new results with the stored ones, keeps them as the
+    new snapshot, and returns only the products that changed """
+
+    def __init__(self, path):
+        """
+        >>> store = SnapshotStore(":memory:")
+        >>> changes = store.update("python", [
+        ...     Product({'asin': 'A1', 'title': 'Book 1', 'rating': '4.5'}),
+        ...     Product({'asin': 'A2', 'title': 'Book 2'})])
+        >>> [(p.asin, p.change, p.rank) for p in changes]
+        [('A1', 'new', 1), ('A2', 'new', 2)]
+        >>> changes = store.update("python", [
+        ...     Product({'asin': 'A3', 'title': 'Book 3'}),
+        ...     Product({'asin': 'A1', 'title': 'Book 1', 'rating': '4.5'})])
+        >>> for p in changes:
+        ...     print(p.asin, p.change, p.changed_fields, p.previous_rank)
+        A3 new  None
+        A1 changed rank 1
+        A2 dropped  2
+        >>> store.update("python", [
+        ...     Product({'asin': 'A3', 'title': 'Book 3'}),
+        ...     Product({'asin': 'A1', 'title': 'Book 1', 'rating': '4.5'})])
+        []
+        """
+        self.path = path
+        # the rows of a search are read with the primary key
+        self._database = Database(path, [
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            'key TEXT, asin TEXT, rank INTEGER, prices_main REAL, '
+            'rating REAL, review_nb INTEGER, title TEXT, url TEXT, '
+            'img TEXT, updated_at REAL, PRIMARY KEY (key, asin)) '
+            'WITHOUT ROWID'])
+
+    def get(self, key):
+        """ Returns the snapshot of the search : a dict of the fields of each
+        product, by ASIN """
+        columns = _TRACKED_FIELDS + _DESCRIPTION_FIELDS
+        with self._database.connect() as connection:
+            return {row[0]: dict(zip(columns, row[1:]))
+                    for row in connection.execute(
+                        'SELECT asin, ' + ', '.join(columns) +
+                        ' FROM snapshots WHERE key = ?', (key,))}
+
+    def update(self, key, products):
+        """ Replace the snapshot of the search by the `products` (`Product`
+        objects, in the order of the results), and returns the products that
+        changed : the new ones, those whose tracked fields changed (in the
+        order of the results), then the dropped ones (in their previous
+        order), with the `DIFF_COLUMNS` fields. The products without ASIN are
+        ignored. Only the changes are written """
+        changes = []
+        rows = []
+        seen = set()
+        with self._database.connect() as connection, connection:
+            snapshot = self.get(key)
+            for product in products:
+                # a product may be shown twice (ex : sponsored)
+                if not product.asin or product.asin in seen:
+                    continue
+                seen.add(product.asin)
+                values = {'rank': len(seen)}
+                for field in _TRACKED_FIELDS[1:] + _DESCRIPTION_FIELDS:
+                    values[field] = _stored_value(getattr(product, field))
+
+                previous = snapshot.get(product.asin)
+                if previous is None:
+                    change = 'new'
+                    changed_fields = []
+                    previous = {}
+                else:
+                    changed_fields = [field for field in _TRACKED_FIELDS
+                                      if values[field] != previous[field]]
+                    if not changed_fields:
+                        continue
+                    change = 'changed'
+                rows.append((key, product.asin) + tuple(
+                    values[field]
+                    for field in _TRACKED_FIELDS + _DESCRIPTION_FIELDS))
+                changes.append(self._changed_product(
+                    product.product, change, changed_fields, values['rank'],
+                    previous))
+
+            dropped = sorted(
+                (asin for asin in snapshot if asin not in seen),
+                key=lambda asin: snapshot[asin]['rank'])
+            for asin in dropped:
+                previous = snapshot[asin]
+                changes.append(self._changed_product(
+                    dict({field: previous[field]
+                          for field in _DESCRIPTION_FIELDS}, asin=asin),
+                    'dropped', [], None, previous))
+
+            now = time.time()
+            connection.executemany(
+                'INSERT OR REPLACE INTO snapshots '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [row + (now,) for row in rows])
+            connection.executemany(
+                'DELETE FROM snapshots WHERE key = ? AND asin = ?',
+                [(key, asin) for asin in dropped])
+        return changes
+
+    def _changed_product(self, product_dict, change, changed_fields, rank,
+                         previous):
+        """ Returns the `Product` of a change, with the `DIFF_COLUMNS` """
+        product_dict = dict(product_dict, change=change,
+                            changed_fields=', '.join(changed_fields),
+                            rank=rank)
+        for field in _TRACKED_FIELDS:
+            product_dict['previous_' + field] = previous.get(field)
+        return Product(product_dict)
+
+    def reset(self, key):
+        """ Forget the snapshot of the search """
+        with self._database.connect() as connection, connection:
+            connection.execute('DELETE FROM snapshots WHERE key = ?', (key,))
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Module to write the products to CSV or JSON Lines files, as they are found
+"""
+
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import sys
+import uuid
+from amazonscraper import Product
+
+# Formats of the files, by extension (after the compression extension)
+_FORMAT_EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+_COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+# Size of the buffer of the files (the rows are written by blocks)
+_BUFFER_SIZE = 1 << 16
+
+
+def get_file_format(path):
+    """ Returns the format and the compression of a file, from its extension
+    (CSV and no compression by default)
+    >>> get_file_format("products.jsonl.gz")
+    ('jsonl', 'gzip')
+    >>> get_file_format("products.csv.zst")
+    ('csv', 'zstd')
+    >>> get_file_format("products.txt")
+    ('csv', None)
+    """
+    root, extension = os.path.splitext(path.lower())
+    compression = _COMPRESSION_EXTENSIONS.get(extension)
+    if compression is not None:
+        root, extension = os.path.splitext(root)
+    return _FORMAT_EXTENSIONS.get(extension, 'csv'), compression
+
+
+def _csv_value(value):
+    """ Returns the value written in a CSV cell (empty if missing)
+    >>> _csv_value(float('nan')), _csv_value(None), _csv_value(4.5)
+    ('', '', 4.5)
+    """
+    if value is None or (value.__class__ is float and math.isnan(value)):
+        return ""
+    return value
+
+
+def _json_value(value):
+    """ Returns the value written in JSON (null if missing, as JSON has no
+    NaN) """
+    if value.__class__ is float and math.isnan(value):
+        return None
+    return value
+
+
+class ProductWriter(object):
+    """Write the products to a CSV or JSON Lines file (`output_format`, from
+    the extension of `path` if None), compressed with gzip or zstd if its
+    extension is .gz or .zst (zstd requires zstandard), to the standard
+    output if `path` is None or "-", or to `path` if it is a text file object.
+
+    The rows are written one at a time through a buffer, so that the memory
+    does not depend on the number of products. The columns are
+    `prefix_columns` (ex : the keywords of the search), then `columns` (the
+    fields of `Product` by default), whatever the fields of the products.
+
+    The file is written under a temporary name and renamed by `close()`, so
+    that an interrupted export does not leave a truncated file (`abort()`
+    removes it). Used as a context manager, the file is closed, or aborted
+    after an exception """
+
+    def __init__(self, path=None, output_format=None, separator=",",
+                 columns=None, prefix_columns=()):
+        """
+        >>> writer = ProductWriter(separator=";")
+        title;rating;review_nb;img;url;asin;prices_per_unit;units;prices_main
+        >>> writer.write(Product({'title': 'Book', 'rating': '4.5',\
+'asin': 'A1'}))
+        Book;4.5;;;;A1;;;
+        >>> writer = ProductWriter(output_format="jsonl", columns=["title",\
+"rating"], prefix_columns=["keywords"])
+        >>> writer.write({'title': 'Book', 'units': 'Count'},\
+keywords="python")
+        {"keywords": "python", "title": "Book", "rating": null}
+        """
+        compression = None
+        stream = None
+        if path is None or path == "-":
+            stream = sys.stdout
+        elif hasattr(path, 'write'):
+            stream = path
+            path = None
+        else:
+            path_format, compression = get_file_format(path)
+            if output_format is None:
+                output_format = path_format
+        self.path = path
+        self.output_format = output_format or 'csv'
+        self.columns = list(prefix_columns) + list(
+            columns if columns is not None else Product._FIELDS)
+        self.row_nb = 0
+        self._temp_path = None
+        self._binary_file = None
+        self._compressed_file = None
+
+        # checked before the file is created
+        if self.output_format not in ('csv', 'jsonl'):
+            raise ValueError(
+                'Unknown output format: {}'.format(self.output_format))
+        if compression == 'zstd':
+            zstandard = _import_zstandard()
+
+        if stream is not None:
+            self._file = stream
+        else:
+            self._temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+            self._binary_file = open(self._temp_path, 'xb',
+                                     buffering=_BUFFER_SIZE)
+            try:
+                if compression == 'gzip':
+                    self._compressed_file = gzip.GzipFile(
+                        fileobj=self._binary_file, mode='wb')
+                elif compression == 'zstd':
+                    self._compressed_file = zstandard.ZstdCompressor(
+                    ).stream_writer(self._binary_file, closefd=False)
+                self._file = io.TextIOWrapper(
+                    self._compressed_file or self._binary_file,
+                    encoding='utf-8', newline='')
+            except BaseException:
+                self._binary_file.close()
+                os.remove(self._temp_path)
+                raise
+
+        if self.output_format == 'csv':
+            self._csv_writer = csv.writer(self._file, delimiter=separator,
+                                          lineterminator='\n')
+            try:
+                self._csv_writer.writerow(self.columns)
+            except BaseException:
+                self.abort()
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, product, **fields):
+        """ Write a product (`Product` or dict), with the values of the
+        prefix columns in `fields` """
+        if isinstance(product, Product):
+            product = product.product
+        if fields:
+            product = dict(product, **fields)
+        if self.output_format == 'csv':
+            self._csv_writer.writerow(
+                [_csv_value(product.get(column)) for column in self.columns])
+        else:
+            self._file.write(json.dumps(
+                {column: _json_value(product.get(column))
+                 for column in self.columns}, ensure_ascii=False) + '\n')
+        self.row_nb += 1
+
+    def write_products(self, products, **fields):
+        """ Write all the products, with the same values of the prefix
+        columns """
+        for product in products:
+            self.write(product, **fields)
+
+    def flush(self):
+        """ Write the buffered rows (ex : to the standard output) """
+        self._file.flush()
+
+    def close(self):
+        """ Write the buffered rows, and give its final name to the file """
+        if self._temp_path is None:
+            self.flush()
+            return
+        self._close_files()
+        os.replace(self._temp_path, self.path)
+        self._temp_path = None
+
+    def abort(self):
+        """ Close and remove the file being written """
+        if self._temp_path is None:
+            return
+        self._close_files()
+        os.remove(self._temp_path)
+        self._temp_path = None
+
+    def _close_files(self):
+        # flush the text, without closing the binary files
+        self._file.detach()
+        if self._compressed_file is not None:
+            # write the end of the compressed data
+            self._compressed_file.close()
+        # the data reaches the disk before the file is renamed
+        self._binary_file.flush()
+        os.fsync(self._binary_file.fileno())
+        self._binary_file.close()
+
+
+def _import_zstandard():
+    """ Returns the zstandard module, which is an optional dependency """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compression requires zstandard \
+(pip install zstandard)')
+    return zstandard
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the parsing of a recorded result page : BeautifulSoup parsing,
+then extraction of the products with `Client._extract_products`.
+
+Usage : python benchmarks/bench_extract.py [--repeat 20] [--parser lxml]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
+
+from bs4 import BeautifulSoup  # noqa: E402
+from amazonscraper.client import Client  # noqa: E402
+from replay_server import load_page, repeat_products  # noqa: E402
+
+_PRODUCT_COPIES = 12
+
+
+def _mean_time(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--parser', default=None,
+                        help='BeautifulSoup parser (ex : lxml)')
+    args = parser.parse_args()
+
+    page = repeat_products(
+        load_page("search_result_mobile.html"), _PRODUCT_COPIES)
+    client = Client(parser=args.parser)
+    soup = BeautifulSoup(page, client.parser)
+    client.base_url = "https://www.amazon.com/"
+    plan, products = client._select_products(soup)
+
+    def extract():
+        client.product_dict_list = []
+        client._extract_products(products, plan, max_product_nb=len(products))
+
+    parse_time = _mean_time(
+        lambda: BeautifulSoup(page, client.parser),
+        args.repeat)
+    extract_time = _mean_time(extract, args.repeat)
+
+    print('page of {} products ({} KB)'.format(
+        len(products), len(page) // 1024))
+    print('BeautifulSoup parsing ({}) : {:.1f} ms'.format(
+        client.parser, parse_time * 1000))
+    print('product extraction    : {:.1f} ms'.format(extract_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
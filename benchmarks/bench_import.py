@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the start-up time of short-lived processes : `import
+amazonscraper` (the clients and their dependencies are imported on their
+first use), the import of the clients, and `amazon2csv.py --version`.
+
+Usage : python benchmarks/bench_import.py [--runs 20]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+_COMMANDS = [
+    ('python -c "pass"', [sys.executable, '-c', 'pass']),
+    ('import amazonscraper',
+     [sys.executable, '-c', 'import amazonscraper']),
+    ('import amazonscraper.client',
+     [sys.executable, '-c', 'import amazonscraper.client']),
+    ('amazon2csv.py --version',
+     [sys.executable, os.path.join(_ROOT_DIR, 'amazon2csv.py'),
+      '--version']),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=_ROOT_DIR)
+    for name, command in _COMMANDS:
+        durations = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run(command, env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+            durations.append(time.perf_counter() - start)
+        print('{:<30} median {:6.1f} ms, min {:6.1f} ms'.format(
+            name, statistics.median(durations) * 1000,
+            min(durations) * 1000))
+
+
+if __name__ == "__main__":
+    main()
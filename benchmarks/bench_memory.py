@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the memory used by the products : slotted `Product` objects
+versus the former wrapper of a dict per product.
+
+Usage : python benchmarks/bench_memory.py [--products 100000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from amazonscraper import Product  # noqa: E402
+
+
+class _DictProduct(object):
+    """The former representation of a product : a wrapper of its dict"""
+    def __init__(self, product_dict={}):
+        self.product = product_dict
+
+    def __getattr__(self, attr):
+        return self.product.get(attr, "")
+
+
+def _product_dict(index):
+    """ Returns a product dict, as built by `Client._extract_products` """
+    return {
+        'title': 'Python Crash Course, 2nd Edition #%d' % index,
+        'rating': 4.7,
+        'review_nb': 3441 + index,
+        'img': 'https://images-na.ssl-images-amazon.com/images/I/%d.jpg'
+               % index,
+        'url': 'https://www.amazon.com/Python-Crash-Course/dp/%010d' % index,
+        'asin': '%010d' % index,
+        'prices_per_unit': float('nan'),
+        'units': float('nan'),
+        'prices_main': 22.49,
+    }
+
+
+def _measure(product_class, product_nb):
+    """ Returns the memory (bytes) used by the products themselves, and the
+    construction time (seconds) """
+    product_dicts = [_product_dict(index) for index in range(product_nb)]
+    tracemalloc.start()
+    start = time.perf_counter()
+    # the dicts given to the former wrapper are kept alive by the products
+    products = [product_class(dict(product_dict))
+                for product_dict in product_dicts]
+    duration = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(products) == product_nb
+    return memory, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--products', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('{} products'.format(args.products))
+    for name, product_class in [('dict wrapper', _DictProduct),
+                                ('slotted Product', Product)]:
+        memory, duration = _measure(product_class, args.products)
+        print('{:16}: {:6.1f} MB, {:4.0f} bytes/product, built in {:.2f} s'
+              .format(name, memory / 1e6, memory / args.products, duration))
+
+
+if __name__ == "__main__":
+    main()
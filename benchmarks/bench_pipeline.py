@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the pipelined mode of `search` (the next page is downloaded
+while the current one is parsed), against a local replay of a recorded result
+page, served with a simulated network latency.
+
+Usage : python benchmarks/bench_pipeline.py [--pages 20] [--latency 0.2]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
+
+import amazonscraper  # noqa: E402
+from replay_server import ReplayServer, load_page, \
+    repeat_products  # noqa: E402
+
+# Number of copies of the recorded products in the page, to get a page
+# with as many products as a real Amazon result page
+_PRODUCT_COPIES = 12
+
+
+def _timed_search(server, max_product_nb, pipeline):
+    start = time.perf_counter()
+    products = amazonscraper.search(
+        search_url=server.url + "s?k=python",
+        max_product_nb=max_product_nb,
+        pipeline=pipeline)
+    duration = time.perf_counter() - start
+    assert len(products) == max_product_nb
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='simulated latency of each request (seconds)')
+    args = parser.parse_args()
+
+    page = repeat_products(
+        load_page("search_result_mobile.html"), _PRODUCT_COPIES)
+    product_nb_per_page = 4 * _PRODUCT_COPIES
+    max_product_nb = args.pages * product_nb_per_page
+
+    with ReplayServer(page, delay=args.latency) as server:
+        serial = _timed_search(server, max_product_nb, pipeline=False)
+        pipelined = _timed_search(server, max_product_nb, pipeline=True)
+
+    print('{} pages of {} products, {:.0f} ms of latency per request'.format(
+        args.pages, product_nb_per_page, args.latency * 1000))
+    print('serial    : {:.2f} s'.format(serial))
+    print('pipelined : {:.2f} s ({:.0%} of serial)'.format(
+        pipelined, pipelined / serial))
+
+
+if __name__ == "__main__":
+    main()
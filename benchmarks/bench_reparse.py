@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the extraction of archived result pages (`amazonscraper.reparse`)
+with an increasing number of processes, to check that it scales with the
+number of cores.
+
+Usage : python benchmarks/bench_reparse.py [--files 400] [--max-processes 4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
+
+import amazonscraper  # noqa: E402
+from replay_server import load_page, repeat_products  # noqa: E402
+
+_LAYOUTS = ["mobile", "mobile_grid", "desktop", "desktop_2"]
+# Number of copies of the recorded products in the pages, to get pages
+# with as many products as real Amazon result pages
+_PRODUCT_COPIES = 12
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--max-processes', type=int,
+                        default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    pages = [repeat_products(
+        load_page("search_result_{}.html".format(layout)), _PRODUCT_COPIES)
+        for layout in _LAYOUTS]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(args.files):
+            file_name = os.path.join(directory, 'page_{:06d}.html'.format(
+                index))
+            with open(file_name, 'w', encoding='utf-8') as f:
+                f.write(pages[index % len(pages)])
+
+        print('{} pages of {} products'.format(
+            args.files, 4 * _PRODUCT_COPIES))
+        reference_time = None
+        for processes in range(1, args.max_processes + 1):
+            start = time.perf_counter()
+            product_nb = sum(
+                len(products) for _, products in amazonscraper.reparse(
+                    [directory], processes=processes))
+            elapsed = time.perf_counter() - start
+            if reference_time is None:
+                reference_time = elapsed
+            print('{} process(es) : {:.2f} s, {:.0f} pages/s, '
+                  'speedup x{:.1f} ({} products)'.format(
+                      processes, elapsed, args.files / elapsed,
+                      reference_time / elapsed, product_nb))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# The recorded pages and the replay server are shared with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
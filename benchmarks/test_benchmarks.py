@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite (pytest-benchmark) over the recorded result pages of each
+layout, replayed by a local HTTP server : extraction throughput (per page and
+per product field), latency of `search` with a simulated network delay, and
+peak memory of a search.
+
+Usage : python -m pytest benchmarks --no-cov --benchmark-autosave
+Then, to compare a commit with the previous saved run :
+        python -m pytest benchmarks --no-cov --benchmark-compare
+"""
+import tracemalloc
+import pytest
+import amazonscraper
+from replay_server import ReplayServer, load_page, paginate, repeat_products
+
+pytest.importorskip("pytest_benchmark")
+
+_LAYOUTS = ["mobile", "mobile_grid", "desktop", "desktop_2"]
+# Number of copies of the recorded products in the page, to get a page
+# with as many products as a real Amazon result page
+_PRODUCT_COPIES = 12
+_PRODUCTS_PER_PAGE = 4 * _PRODUCT_COPIES
+_PAGE_NB = 5
+_LATENCY = 0.05  # Simulated network delay of each request (seconds)
+
+
+def _load_result_page(layout):
+    return repeat_products(
+        load_page("search_result_{}.html".format(layout)), _PRODUCT_COPIES)
+
+
+@pytest.mark.parametrize("parser", ["html.parser", "lxml"])
+@pytest.mark.parametrize("layout", _LAYOUTS)
+def test_extract_page(benchmark, layout, parser):
+    pytest.importorskip(parser.split(".")[0])
+    page = _load_result_page(layout)
+    amz = amazonscraper.Client(parser=parser)
+    amz._update_headers("https://www.amazon.com/s?k=python")
+
+    def extract_page():
+        amz.product_dict_list = []
+        return amz._extract_page(page, max_product_nb=_PRODUCTS_PER_PAGE)
+
+    benchmark(extract_page)
+    benchmark.extra_info['products_per_page'] = len(amz.product_dict_list)
+    assert len(amz.product_dict_list) == _PRODUCTS_PER_PAGE
+
+
+@pytest.mark.parametrize("field", ["match", "title", "rating", "review_nb",
+                                   "prices"])
+@pytest.mark.parametrize("file_name, search_url", [
+    ("search_result_mobile.html", "https://www.amazon.com/s?k=python"),
+    ("search_result_mobile_fr.html", "https://www.amazon.fr/s?k=python"),
+])
+def test_extract_product_field(benchmark, file_name, search_url, field):
+    amz = amazonscraper.Client()
+    amz._update_headers(search_url)
+    _, plan, products = amz._parse_page(load_page(file_name))
+    product_matches = plan.match(products[-1])
+    extract_field = {
+        # the single walk of the product, finding the elements of the fields
+        "match": lambda: plan.match(products[-1]),
+        "title": lambda: amz._get_title(product_matches),
+        "rating": lambda: amz._get_rating(product_matches),
+        "review_nb": lambda: amz._get_n_ratings(product_matches),
+        "prices": lambda: amz._get_prices(product_matches),
+    }[field]
+
+    benchmark(extract_field)
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+@pytest.mark.parametrize("layout", _LAYOUTS)
+def test_search_latency(benchmark, layout, pipeline):
+    page = _load_result_page(layout)
+    with ReplayServer(paginate(page), delay=_LATENCY) as server:
+        products = benchmark.pedantic(
+            amazonscraper.search,
+            kwargs=dict(search_url=server.url + "s?k=python",
+                        max_product_nb=_PAGE_NB * _PRODUCTS_PER_PAGE,
+                        pipeline=pipeline),
+            rounds=3, iterations=1)
+    benchmark.extra_info['latency'] = _LATENCY
+    assert len(products) == _PAGE_NB * _PRODUCTS_PER_PAGE
+
+
+@pytest.mark.parametrize("layout", _LAYOUTS)
+def test_search_peak_memory(benchmark, layout):
+    page = _load_result_page(layout)
+
+    def traced_search(search_url):
+        tracemalloc.start()
+        try:
+            products = amazonscraper.search(
+                search_url=search_url,
+                max_product_nb=_PAGE_NB * _PRODUCTS_PER_PAGE)
+            return products, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    with ReplayServer(paginate(page)) as server:
+        products, peak_memory = benchmark.pedantic(
+            traced_search, args=(server.url + "s?k=python",),
+            rounds=1, iterations=1)
+    # saved with the timings, to be compared between commits
+    benchmark.extra_info['peak_memory_kb'] = peak_memory // 1024
+    assert len(products) == _PAGE_NB * _PRODUCTS_PER_PAGE
@@ -41,8 +41,13 @@ setup(
     keywords=_MOTS_CLES,
     setup_requires=requirements,
     install_requires=requirements,
+    extras_require={
+        'async': ['aiohttp>=3.0'],
+        'lxml': ['lxml'],
+        'parquet': ['pyarrow'],
+    },
     classifiers=['Programming Language :: Python :: 3'],
-    python_requires='>=3',
+    python_requires='>=3.7',
     tests_require=['pytest'],
 )
 
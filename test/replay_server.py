@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP stand-in for Amazon, replaying saved result pages
+"""
+import copy
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from bs4 import BeautifulSoup
+from amazonscraper.client import _EXTRACTION_PLAN_LIST
+
+_TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_page(file_name):
+    """ Returns the content of a saved page of the test folder """
+    with open(os.path.join(_TEST_DIR, file_name), encoding='utf-8') as f:
+        return f.read()
+
+
+def repeat_products(page, copies):
+    """ Returns the result `page` (of any layout) with its products repeated
+    `copies` times, to get as many products as on a real Amazon result page
+    """
+    soup = BeautifulSoup(page, "html.parser")
+    for plan in _EXTRACTION_PLAN_LIST:
+        products = plan.product.select(soup)
+        if products:
+            break
+    last = products[-1]
+    for _ in range(copies - 1):
+        for product in products:
+            product_copy = copy.copy(product)
+            last.insert_after(product_copy)
+            last = product_copy
+    return str(soup)
+
+
+def paginate(page):
+    """ Returns a function serving the result `page` for any page number, with
+    a link to the following page number (instead of always the page 2) """
+    def serve(path):
+        query = parse_qs(urlsplit(path).query)
+        next_page_nb = int(query.get('page', ['1'])[0]) + 1
+        return page.replace(
+            'page=2&amp;ref=sr_pg_2',
+            'page={0}&amp;ref=sr_pg_{0}'.format(next_page_nb))
+    return serve
+
+
+class ReplayServer(object):
+    """ Serve `page` for every GET request, after waiting `delay` seconds
+
+    `page` may also be a callable taking the request path and returning the
+    HTML content (or None for a 404).
+    With an `etag`, the pages are sent with this ETag, and the conditional
+    requests matching it get a 304 response """
+
+    def __init__(self, page, delay=0, etag=None):
+        self.page = page
+        self.delay = delay
+        self.etag = etag
+        self.requests = []
+        self.connections = set()  # Client addresses (one per connection)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.max_in_flight = 0
+        self._server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self._server.server_address[1]
+
+    def _handler_class(self):
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            # keep the connections alive
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._serve(self)
+
+            def log_message(self, *args):
+                pass
+
+        return _Handler
+
+    def _serve(self, handler):
+        with self._lock:
+            self.requests.append(handler.path)
+            self.connections.add(handler.client_address)
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if self.etag is not None and \
+                    handler.headers.get('If-None-Match') == self.etag:
+                handler.send_response(304)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            if callable(self.page):
+                content = self.page(handler.path)
+            else:
+                content = self.page
+            if content is None:
+                handler.send_response(404)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            body = content.encode('utf-8')
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'text/html; charset=utf-8')
+            handler.send_header('Content-Length', str(len(body)))
+            if self.etag is not None:
+                handler.send_header('ETag', self.etag)
+            handler.end_headers()
+            try:
+                handler.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading the page
+                handler.close_connection = True
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
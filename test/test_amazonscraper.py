@@ -1,7 +1,22 @@
+import asyncio
+import glob
+import gzip
+import json
+import math
+import os
+import subprocess
+import sys
 import amazonscraper
 import pytest
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from replay_server import ReplayServer, load_page, paginate, \
+    repeat_products
 
 _MAX_PRODUCT_NB = 10
+_RESULT_PAGES = sorted(
+    os.path.basename(path) for path in glob.glob(
+        os.path.join(os.path.dirname(__file__), "search_result_*.html")))
 
 
 def test_amazonscraper_get_products_with_keywords():
@@ -81,3 +96,949 @@ def test_amazonscraper_csv_header():
     with open('test.csv') as f:
         csv_str = f.read()
     assert "title,rating,review_nb,img,url,asin,prices_per_unit,units,prices_main"  in csv_str
+
+
+def test_amazonscraper_search_many():
+    page = load_page("search_result_mobile.html")
+    keywords_list = ["python", "scraping", "asyncio"]
+    with ReplayServer(page, delay=0.05) as server:
+        results = dict(amazonscraper.search_many(
+                                keywords_list,
+                                concurrency=3,
+                                max_product_nb=6,
+                                max_requests_per_host=2,
+                                base_url=server.url))
+
+    assert sorted(results) == sorted(keywords_list)
+    for products in results.values():
+        assert len(products) == 6
+        assert products[0].asin == "1449355730"
+    # 2 pages per search, never more than 2 requests at a time on the host
+    assert len(server.requests) == 6
+    assert server.max_in_flight <= 2
+
+
+def test_amazonscraper_search_many_releases_results():
+    import gc
+    import weakref
+    page = load_page("search_result_mobile.html")
+    with ReplayServer(page) as server:
+        results = amazonscraper.search_many(
+            ["python", "scraping", "asyncio"], concurrency=1,
+            max_product_nb=4, base_url=server.url)
+        keywords, products = next(results)
+        first_products = weakref.ref(products)
+        del products
+        next(results)
+        gc.collect()
+        # the results already yielded are not kept by the generator
+        assert first_products() is None
+        results.close()
+
+
+def test_amazonscraper_search_many_return_exceptions(monkeypatch):
+    monkeypatch.setattr(amazonscraper.ratelimit, "_MAX_BACKOFF_DELAY", 0)
+    with ReplayServer(None) as server:
+        results = list(amazonscraper.search_many(
+                                ["python"],
+                                max_product_nb=_MAX_PRODUCT_NB,
+                                return_exceptions=True,
+                                base_url=server.url))
+    assert len(results) == 1
+    assert isinstance(results[0][1], Exception)
+
+
+def test_amazonscraper_iter_search_many():
+    page = load_page("search_result_mobile.html")
+    keywords_list = ["python", "scraping"]
+    with ReplayServer(paginate(page)) as server:
+        results = list(amazonscraper.iter_search_many(
+                                keywords_list,
+                                concurrency=2,
+                                max_product_nb=10,
+                                base_url=server.url))
+        assert len(server.requests) == 6
+
+        # the searches stop when the caller stops iterating
+        server.requests.clear()
+        products = amazonscraper.iter_search_many(
+                                ["asyncio"],
+                                concurrency=1,
+                                max_product_nb=1000,
+                                base_url=server.url)
+        next(products)
+        products.close()
+        assert len(server.requests) <= 4
+
+    for keywords in keywords_list:
+        products = [product for result_keywords, product in results
+                    if result_keywords == keywords]
+        assert len(products) == 10
+        assert products[0].asin == "1449355730"
+
+
+def test_amazonscraper_product_writer_errors(tmp_path, monkeypatch):
+    from amazonscraper import writers
+
+    def import_zstandard():
+        raise ImportError("zstandard")
+
+    monkeypatch.setattr(writers, "_import_zstandard", import_zstandard)
+    with pytest.raises(ValueError):
+        amazonscraper.ProductWriter(str(tmp_path / "products.csv"),
+                                    output_format="xml")
+    with pytest.raises(ImportError):
+        amazonscraper.ProductWriter(str(tmp_path / "products.csv.zst"))
+    # no temporary file is left
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_amazonscraper_product_writer(tmp_path):
+    products = amazonscraper.extract_products(
+        load_page("search_result_mobile.html"))
+    products[0].extra = {"brand": "O'Reilly"}
+
+    csv_file = str(tmp_path / "products.csv")
+    products.csv(csv_file, separator=";")
+    with open(csv_file) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "title;rating;review_nb;img;url;asin;" \
+        "prices_per_unit;units;prices_main;brand"
+    assert len(lines) == 5
+    assert lines[1].endswith(";1449355730;;;39.99;O'Reilly")
+
+    # compressed JSON Lines, with a fixed schema
+    jsonl_file = str(tmp_path / "products.jsonl.gz")
+    with amazonscraper.ProductWriter(
+            jsonl_file, prefix_columns=["keywords"]) as writer:
+        writer.write_products(products, keywords="python")
+    with gzip.open(jsonl_file, "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    assert len(rows) == 4
+    assert list(rows[0]) == ["keywords"] + list(amazonscraper.Product._FIELDS)
+    assert rows[0]["keywords"] == "python"
+    assert rows[0]["rating"] == 4.5
+    assert rows[0]["units"] is None
+
+    # an interrupted export leaves no file
+    with pytest.raises(KeyboardInterrupt):
+        with amazonscraper.ProductWriter(
+                str(tmp_path / "interrupted.csv")) as writer:
+            writer.write_products(products)
+            raise KeyboardInterrupt
+    assert sorted(os.listdir(str(tmp_path))) == \
+        ["products.csv", "products.jsonl.gz"]
+
+
+def test_amazonscraper_diff(tmp_path):
+    page = load_page("search_result_mobile.html")
+    store = amazonscraper.SnapshotStore(str(tmp_path / "snapshots.db"))
+    with ReplayServer(page) as server:
+        search_url = server.url + "s?k=python"
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=4, diff_against=store)
+        assert [product.change for product in products] == ["new"] * 4
+        assert [product.rank for product in products] == [1, 2, 3, 4]
+
+        # nothing changed
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=4, diff_against=store)
+        assert len(products) == 0
+
+        # the price of the 1st product changed, the 4th one is not found
+        server.page = page.replace("$39.99", "$34.99")
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=3, diff_against=store)
+    assert [(product.asin, product.change) for product in products] == \
+        [("1449355730", "changed"), ("1492051365", "dropped")]
+    changed, dropped = products
+    assert changed.changed_fields == "prices_main"
+    assert changed.prices_main == 34.99
+    assert changed.previous_prices_main == 39.99
+    assert dropped.previous_rank == 4
+    assert dropped.title != ""
+    assert products.stats["diff_changed"] == 1
+    assert products.stats["diff_dropped"] == 1
+    # the snapshot holds the last results
+    with store._database.connect() as connection:
+        assert connection.execute(
+            "SELECT COUNT(*) FROM snapshots").fetchone()[0] == 3
+
+
+def test_amazonscraper_memory_diff_threads():
+    store = amazonscraper.SnapshotStore(":memory:")
+    with ReplayServer(load_page("search_result_mobile.html")) as server:
+        # the searches run in the threads of search_many
+        runs = [dict(amazonscraper.search_many(
+            ["python"], base_url=server.url, max_product_nb=4,
+            diff_against=store)) for _ in range(2)]
+
+    assert len(runs[0]["python"]) == 4
+    assert len(runs[1]["python"]) == 0
+
+
+def test_amazonscraper_async_search():
+    pytest.importorskip("aiohttp")
+    page = load_page("search_result_mobile.html")
+
+    async def run_searches(search_url):
+        return await asyncio.gather(*[
+            amazonscraper.async_search(
+                search_url=search_url,
+                max_product_nb=_MAX_PRODUCT_NB)
+            for _ in range(5)])
+
+    with ReplayServer(page, delay=0.05) as server:
+        results = asyncio.run(run_searches(server.url + "s?k=python"))
+
+    assert server.max_in_flight > 1
+    for products in results:
+        assert isinstance(products, amazonscraper.Products)
+        assert len(products) == _MAX_PRODUCT_NB
+        assert products[0].title == "Learning Python, 5th Edition"
+        assert products.last_html_page == page
+
+
+def test_amazonscraper_async_client_retries(monkeypatch):
+    aiohttp = pytest.importorskip("aiohttp")
+    from amazonscraper.async_client import AsyncClient
+    monkeypatch.setattr(amazonscraper.ratelimit, "_MAX_BACKOFF_DELAY", 0)
+
+    def new_session(pool_size):
+        raise AssertionError("requests session created")
+
+    monkeypatch.setattr(amazonscraper.client, "new_session", new_session)
+    page = load_page("search_result_mobile.html")
+    errors = [aiohttp.ServerDisconnectedError(), asyncio.TimeoutError()]
+
+    async def get(self, url):
+        if errors:
+            raise errors.pop(0)
+        return page
+
+    monkeypatch.setattr(AsyncClient, "_get", get)
+    amz = AsyncClient()
+    assert amz.session is None
+    content = asyncio.run(amz._get_page_html("https://www.amazon.com/s?k=a"))
+
+    # the connection errors are retried
+    assert content == page
+    assert amz.stats["retries"] == 2
+
+
+def test_amazonscraper_async_search_last_page():
+    pytest.importorskip("aiohttp")
+    # a single page of results, without a next page link
+    page = load_page("search_result_mobile.html").replace(
+        'class="a-last"', 'class="a-disabled"')
+    with ReplayServer(page) as server:
+        search_url = server.url + "s?k=python"
+        products = asyncio.run(amazonscraper.async_search(
+            search_url=search_url, max_product_nb=4))
+        serial = amazonscraper.search(search_url=search_url,
+                                      max_product_nb=4)
+        # more products than the last page has
+        with pytest.raises(ValueError):
+            asyncio.run(amazonscraper.async_search(search_url=search_url,
+                                                   max_product_nb=5))
+
+    assert [p.asin for p in products] == [p.asin for p in serial]
+    assert len(products) == 4
+
+
+def test_amazonscraper_pipelined_search():
+    page = load_page("search_result_mobile.html")
+    with ReplayServer(page) as server:
+        search_url = server.url + "s?k=python"
+        serial = amazonscraper.search(search_url=search_url,
+                                      max_product_nb=_MAX_PRODUCT_NB)
+        request_nb = len(server.requests)
+        pipelined = amazonscraper.search(search_url=search_url,
+                                         max_product_nb=_MAX_PRODUCT_NB,
+                                         pipeline=True)
+
+    # No page is downloaded in advance when it is not needed
+    assert len(server.requests) == 2 * request_nb
+    # (compared as strings, since NaN != NaN)
+    assert [repr(p.product) for p in pipelined] == \
+        [repr(p.product) for p in serial]
+
+
+def test_amazonscraper_extract_page():
+    amz = amazonscraper.Client()
+    amz._update_headers("https://www.amazon.com/s?k=python")
+    next_url = amz._extract_page(load_page("search_result_mobile.html"),
+                                 max_product_nb=_MAX_PRODUCT_NB)
+
+    assert next_url == "https://www.amazon.com/s?k=python&page=2&ref=sr_pg_2"
+    assert len(amz.product_dict_list) == 4
+    product = amz.product_dict_list[2]
+    assert product['title'] == "Python Programming: A Beginner's Guide"
+    assert product['rating'] == 4.1
+    assert product['review_nb'] == 87
+    assert product['asin'] == "B07K3FN5MR"
+    assert product['url'] == "https://www.amazon.com/\
+Python-Programming-Beginners-Guide/dp/B07K3FN5MR"
+    assert product['img'] == "https://images-na.ssl-images-amazon.com/\
+images/I/41f2mHXvOsL.jpg"
+    assert product['prices_main'] == 9.99
+    assert product['prices_per_unit'] == 0.5
+    assert product['units'] == "Count"
+    # the strikethrough price is ignored
+    assert amz.product_dict_list[0]['prices_main'] == 39.99
+
+
+@pytest.mark.parametrize("layout", ["mobile", "mobile_grid", "desktop",
+                                    "desktop_2"])
+def test_amazonscraper_layouts(layout):
+    amz = amazonscraper.Client()
+    amz._update_headers("https://www.amazon.com/s?k=python")
+    next_url = amz._extract_page(
+        load_page("search_result_{}.html".format(layout)),
+        max_product_nb=_MAX_PRODUCT_NB)
+
+    # the recorded pages of all the layouts show the same products
+    assert amz.stats['layout_' + layout] == 1
+    assert next_url == "https://www.amazon.com/s?k=python&page=2&ref=sr_pg_2"
+    assert [product['asin'] for product in amz.product_dict_list] == \
+        ["1449355730", "1593279280", "B07K3FN5MR", "1492051365"]
+    product = amz.product_dict_list[2]
+    assert product['title'] == "Python Programming: A Beginner's Guide"
+    assert product['rating'] == 4.1
+    assert product['review_nb'] == 87
+    assert product['prices_main'] == 9.99
+    assert product['units'] == "Count"
+
+
+@pytest.mark.parametrize("file_name", _RESULT_PAGES)
+@pytest.mark.parametrize("parser", ["lxml", "html5lib"])
+def test_amazonscraper_parser_parity(file_name, parser):
+    pytest.importorskip(parser)
+    page = load_page(file_name)
+    product_dict_lists = []
+    for amz in [amazonscraper.Client(), amazonscraper.Client(parser=parser)]:
+        amz._update_headers("https://www.amazon.com/s?k=python")
+        amz._extract_page(page, max_product_nb=100)
+        product_dict_lists.append(repr(amz.product_dict_list))
+
+    assert product_dict_lists[0] == product_dict_lists[1]
+
+
+def test_amazonscraper_layout_cache():
+    page = load_page("search_result_mobile.html")
+    with ReplayServer(page) as server:
+        products = amazonscraper.search(search_url=server.url + "s?k=python",
+                                        max_product_nb=_MAX_PRODUCT_NB)
+
+    # 3 pages : the layout is searched on the first one only
+    assert products.stats['layout_misses'] == 1
+    assert products.stats['layout_hits'] == 2
+    assert products.stats['layout_mobile'] == 3
+    # the title and number of ratings selectors are found on the 1st product
+    assert products.stats['field_misses'] == 2
+    assert products.stats['field_hits'] == 2 * (_MAX_PRODUCT_NB - 1)
+
+
+def test_amazonscraper_load_layouts(tmp_path, monkeypatch):
+    client = amazonscraper.client
+    monkeypatch.setattr(client, "_EXTRACTION_PLAN_LIST",
+                        list(client._EXTRACTION_PLAN_LIST))
+    # Amazon renamed the list of the products of the mobile layout
+    page = load_page("search_result_mobile.html").replace(
+        'id="resultItems"', 'id="resultList"')
+    selectors = dict(client._CSS_SELECTORS_MOBILE,
+                     product="#resultList > li")
+    layouts_file = tmp_path / "layouts.json"
+    layouts_file.write_text(json.dumps(
+        {"layouts": [{"name": "mobile", "selectors": selectors},
+                     {"name": "mobile_2", "selectors": selectors}]}))
+    invalid_file = tmp_path / "invalid.json"
+    invalid_file.write_text(json.dumps(
+        {"layouts": [{"name": "mobile", "selectors": {"product": "li"}}]}))
+
+    assert len(amazonscraper.extract_products(page)) == 0
+
+    with pytest.raises(ValueError):
+        amazonscraper.load_layouts(str(invalid_file))
+    assert len(amazonscraper.extract_products(page)) == 0
+    assert amazonscraper.load_layouts(str(layouts_file)) == \
+        ["mobile", "mobile_2"]
+    with ReplayServer(page) as server:
+        products = amazonscraper.search(search_url=server.url + "s?k=python",
+                                        max_product_nb=4)
+    assert len(products) == 4
+    assert products.stats['layout_mobile'] == 1
+    assert [plan.name for plan in client._EXTRACTION_PLAN_LIST] == \
+        ["mobile", "mobile_grid", "desktop", "desktop_2", "mobile_2"]
+
+
+def test_amazonscraper_lazy_imports():
+    # importing the package does not import the clients and their
+    # dependencies
+    modules = subprocess.check_output(
+        [sys.executable, "-c", "import sys, amazonscraper; "
+         "print(' '.join(sorted(sys.modules)))"],
+        cwd=os.path.join(os.path.dirname(__file__), "..")).decode().split()
+    assert "amazonscraper" in modules
+    for module in ["requests", "bs4", "aiohttp", "amazonscraper.client"]:
+        assert module not in modules
+    assert amazonscraper.Client is amazonscraper.client.Client
+
+
+def test_amazonscraper_iter_search():
+    page = load_page("search_result_mobile.html")
+    with ReplayServer(page) as server:
+        products = amazonscraper.iter_search(
+                                search_url=server.url + "s?k=python",
+                                max_product_nb=_MAX_PRODUCT_NB)
+        assert server.requests == []
+
+        product = next(products)
+        assert isinstance(product, amazonscraper.Product)
+        assert product.asin == "1449355730"
+        # the next pages are only requested when their products are needed
+        for _ in range(3):
+            next(products)
+        assert len(server.requests) == 1
+        next(products)
+        assert len(server.requests) == 2
+
+        assert len(list(products)) == _MAX_PRODUCT_NB - 5
+        assert len(server.requests) == 3
+
+
+def test_amazonscraper_html_retention(tmp_path):
+    page = load_page("search_result_mobile.html")
+    with ReplayServer(page) as server:
+        search_url = server.url + "s?k=python"
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=_MAX_PRODUCT_NB)
+        assert len(products.html_pages) == 1
+        assert products.last_html_page == page
+
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=_MAX_PRODUCT_NB,
+                                        html_retention=0)
+        assert len(products.html_pages) == 0
+        assert products.last_html_page == ""
+
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=_MAX_PRODUCT_NB,
+                                        html_dir=str(tmp_path))
+    # 3 pages : 2 compressed on disk and the last one in memory
+    assert len(list(tmp_path.glob("*.html.gz"))) == 2
+    assert list(products.html_pages) == [page] * 3
+    assert products.html_pages[-2:] == [page] * 2
+    assert products.html_pages[::-1] == [page] * 3
+
+
+def test_amazonscraper_to_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    amz = amazonscraper.Client()
+    amz._update_headers("https://www.amazon.com/s?k=python")
+    amz._extract_page(load_page("search_result_mobile.html"),
+                      max_product_nb=_MAX_PRODUCT_NB)
+    products = amazonscraper.Products(amz.product_dict_list)
+
+    file_name = str(tmp_path / "products.parquet")
+    products.to_parquet(file_name)
+    table = pq.read_table(file_name)
+
+    assert table.column_names == list(amazonscraper.Product._FIELDS)
+    assert str(table.schema.field("review_nb").type) == "double"
+    assert table.column("asin").to_pylist() == [p.asin for p in products]
+    assert table.column("rating").to_pylist() == [4.5, 4.7, 4.1, 4.8]
+
+
+def test_amazonscraper_response_cache(tmp_path):
+    page = load_page("search_result_mobile.html")
+    cache_path = str(tmp_path / "cache.sqlite")
+    with ReplayServer(paginate(page), etag='"v1"') as server:
+        search_url = server.url + "s?k=python"
+        products = amazonscraper.search(
+            search_url=search_url, max_product_nb=_MAX_PRODUCT_NB,
+            cache=amazonscraper.ResponseCache(cache_path))
+        assert products.stats['cache_misses'] == 3
+        assert len(server.requests) == 3
+
+        # fresh pages : no request
+        products = amazonscraper.search(
+            search_url=search_url, max_product_nb=_MAX_PRODUCT_NB,
+            cache=amazonscraper.ResponseCache(cache_path))
+        assert products.stats['cache_hits'] == 3
+        assert len(server.requests) == 3
+        assert products[0].asin == "1449355730"
+
+        # stale pages : revalidated with their ETag
+        products = amazonscraper.search(
+            search_url=search_url, max_product_nb=_MAX_PRODUCT_NB,
+            cache=amazonscraper.ResponseCache(cache_path, ttl=0))
+        assert products.stats['cache_revalidations'] == 3
+        assert len(server.requests) == 6
+        assert len(products) == _MAX_PRODUCT_NB
+
+
+def test_amazonscraper_memory_cache_threads():
+    page = load_page("search_result_mobile.html")
+    # the pages are downloaded by a worker thread
+    cache = amazonscraper.ResponseCache(":memory:")
+    with ReplayServer(paginate(page)) as server:
+        search_url = server.url + "s?k=python"
+        for _ in range(2):
+            products = amazonscraper.search(
+                search_url=search_url, max_product_nb=_MAX_PRODUCT_NB,
+                cache=cache, pipeline=True)
+
+    assert products.stats['cache_hits'] == 3
+    assert len(server.requests) == 3
+
+
+def test_amazonscraper_reused_client():
+    page = load_page("search_result_mobile.html")
+    amz = amazonscraper.Client()
+    with ReplayServer(page) as server:
+        search_url = server.url + "s?k=python"
+        first = amazonscraper.search(search_url=search_url,
+                                     max_product_nb=_MAX_PRODUCT_NB,
+                                     client=amz)
+        second = amazonscraper.search(search_url=search_url,
+                                      max_product_nb=3,
+                                      client=amz)
+
+    # the products and statistics of the first search are not mixed in
+    assert len(first) == _MAX_PRODUCT_NB
+    assert len(second) == 3
+    assert first.stats['layout_misses'] == 1
+    assert second.stats['layout_misses'] == 0
+    # all the requests are sent on the same connection
+    assert len(server.requests) == 4
+    assert len(server.connections) == 1
+
+
+def test_amazonscraper_rate_limiter(monkeypatch):
+    monkeypatch.setattr(amazonscraper.ratelimit, "_MAX_BACKOFF_DELAY", 0)
+    page = load_page("search_result_mobile.html")
+    served_pages = []
+
+    def serve(path):
+        # a CAPTCHA for the first request, then the result pages
+        served_pages.append(path)
+        if len(served_pages) == 1:
+            return "<html><title>Robot Check</title></html>"
+        return page
+
+    limiter = amazonscraper.HostRateLimiter(rate=100)
+    with ReplayServer(serve) as server:
+        products = amazonscraper.search(search_url=server.url + "s?k=python",
+                                        max_product_nb=6,
+                                        rate_limiter=limiter)
+    assert len(products) == 6
+    assert len(served_pages) == 3
+    # halved after the CAPTCHA, then increased after the 2 valid pages
+    host = server.url.split("/")[2]
+    assert limiter.get_rate(host) == pytest.approx(70)
+
+
+def test_amazonscraper_aborted_transfer(monkeypatch):
+    monkeypatch.setattr(amazonscraper.ratelimit, "_MAX_BACKOFF_DELAY", 0)
+    page = load_page("search_result_mobile.html")
+    captcha = "<html><title>Robot Check</title>" + "<p>x</p>" * 100000
+    served_pages = []
+
+    def serve(path):
+        # a large CAPTCHA for the first request, then the result pages
+        served_pages.append(path)
+        return captcha if len(served_pages) == 1 else page
+
+    with ReplayServer(serve) as server:
+        products = amazonscraper.search(search_url=server.url + "s?k=python",
+                                        max_product_nb=4)
+    assert len(products) == 4
+    assert products.stats['aborted_transfers'] == 1
+    assert products.stats['failures_robot_check'] == 1
+    # most of the CAPTCHA page was not downloaded
+    assert products.stats['bytes_saved'] > len(captcha) / 2
+    assert products.stats['bytes_downloaded'] < \
+        len(page.encode('utf-8')) + len(captcha) / 2
+
+
+def test_amazonscraper_metrics(capsys):
+    page = load_page("search_result_mobile.html")
+    metrics = []
+    with ReplayServer(page) as server:
+        products = amazonscraper.search(
+            search_url=server.url + "s?k=python",
+            max_product_nb=6,
+            on_metric=lambda name, value: metrics.append(name))
+
+    stats = products.stats
+    assert stats['requests'] == 2
+    assert stats['bytes_downloaded'] == 2 * len(page.encode('utf-8'))
+    assert stats['fetch_time'] > 0
+    assert stats['parse_time'] > 0
+    assert stats['extract_time'] > 0
+    assert stats['products'] == 6
+    assert stats['layout_mobile'] == 2
+    assert stats['retries'] == 0
+    assert set(metrics) == set(stats)
+    # the progress is logged, not printed
+    assert capsys.readouterr().out == ""
+
+
+def test_amazonscraper_extract_products():
+    page = load_page("search_result_mobile.html")
+    products = amazonscraper.extract_products(page, "https://www.amazon.fr/")
+
+    assert len(products) == 4
+    assert products[0].url == "https://www.amazon.fr/\
+Learning-Python-Powerful-Object-Oriented-Programming/dp/1449355730"
+    assert products.stats['layout_mobile'] == 1
+    # the page is extracted the same way at each call
+    assert repr([p.product for p in products]) == repr(
+        [p.product for p in amazonscraper.extract_products(
+            page, "https://www.amazon.fr/")])
+
+
+def test_amazonscraper_load_layouts_fields(tmp_path, monkeypatch, caplog):
+    client = amazonscraper.client
+    monkeypatch.setattr(client, "_EXTRACTION_PLAN_LIST",
+                        list(client._EXTRACTION_PLAN_LIST))
+    # Amazon changed the tag of the titles
+    page = load_page("search_result_mobile.html").replace(
+        "<h5>", "<h6>").replace("</h5>", "</h6>")
+    assert [p.title for p in amazonscraper.extract_products(page)] == [""] * 4
+    selectors = dict(client._CSS_SELECTORS_MOBILE, title="h6 > span",
+                     price="span.a-price")
+    del selectors["rating"]
+    layouts_file = tmp_path / "layouts.json"
+    layouts_file.write_text(json.dumps(
+        {"layouts": [{"name": "mobile", "selectors": selectors}]}))
+
+    amazonscraper.load_layouts(str(layouts_file))
+
+    assert "unknown selectors ignored" in caplog.text
+    assert "price" in caplog.text
+    titles = [p.title for p in amazonscraper.extract_products(page)]
+    assert titles[0] == "Learning Python, 5th Edition"
+    assert "" not in titles
+
+
+def test_amazonscraper_reparse(tmp_path):
+    layouts = ["mobile", "mobile_grid", "desktop", "desktop_2"]
+    for layout in layouts:
+        page = load_page("search_result_{}.html".format(layout))
+        (tmp_path / (layout + ".html")).write_text(page, encoding="utf-8")
+    # the pages spilled by the clients are compressed
+    with gzip.open(str(tmp_path / "spilled.html.gz"), "wt") as f:
+        f.write(load_page("search_result_mobile.html"))
+    (tmp_path / "notes.txt").write_text("not a page")
+
+    results = list(amazonscraper.reparse([str(tmp_path)], processes=2,
+                                         chunksize=2))
+
+    assert [os.path.basename(path) for path, _ in results] == \
+        sorted(layout + ".html" for layout in layouts) + ["spilled.html.gz"]
+    for path, products in results:
+        assert [product.asin for product in products] == \
+            ["1449355730", "1593279280", "B07K3FN5MR", "1492051365"]
+
+
+def test_amazonscraper_reparse_window(tmp_path, monkeypatch):
+    from amazonscraper import archive
+    submitted = []
+
+    class Executor(ThreadPoolExecutor):
+        def __init__(self, max_workers, initializer, initargs):
+            ThreadPoolExecutor.__init__(self, max_workers=max_workers)
+
+        def submit(self, function, chunk, *args):
+            submitted.append(chunk)
+            return ThreadPoolExecutor.submit(self, function, chunk, *args)
+
+    monkeypatch.setattr(archive, "ProcessPoolExecutor", Executor)
+    page = load_page("search_result_mobile.html")
+    for index in range(10):
+        (tmp_path / "{}.html".format(index)).write_text(page,
+                                                        encoding="utf-8")
+
+    results = amazonscraper.reparse([str(tmp_path)], processes=2,
+                                    chunksize=1)
+    next(results)
+    # 2 chunks per process are extracted in advance, not all the files
+    assert len(submitted) == 4
+    assert len(list(results)) == 9
+    assert len(submitted) == 10
+
+
+def test_amazonscraper_reparse_layouts(tmp_path, monkeypatch):
+    import functools
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from amazonscraper import archive
+    # the processes do not inherit the layouts of the current process
+    monkeypatch.setattr(archive, "ProcessPoolExecutor", functools.partial(
+        ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn")))
+    page = load_page("search_result_mobile.html").replace(
+        'id="resultItems"', 'id="resultList"')
+    for index in range(2):
+        (tmp_path / "{}.html".format(index)).write_text(page,
+                                                        encoding="utf-8")
+    selectors = dict(amazonscraper.client._CSS_SELECTORS_MOBILE,
+                     product="#resultList > li")
+    layouts_file = tmp_path / "layouts.json"
+    layouts_file.write_text(json.dumps(
+        {"layouts": [{"name": "mobile", "selectors": selectors}]}))
+
+    results = list(amazonscraper.reparse([str(tmp_path)], processes=2,
+                                         chunksize=1,
+                                         layouts=str(layouts_file)))
+
+    assert [len(products) for path, products in results] == [4, 4]
+
+
+def test_amazonscraper_checkpoint(tmp_path):
+    serve_page = paginate(load_page("search_result_mobile.html"))
+
+    def serve(path):
+        # 3 pages of results : from the 2nd page, 3 new products and the
+        # first product again
+        page = serve_page(path)
+        page_nb = int(parse_qs(urlsplit(path).query).get('page', ['1'])[0])
+        if page_nb > 1:
+            for index, asin in enumerate(
+                    ["1593279280", "B07K3FN5MR", "1492051365"], 2):
+                page = page.replace(asin, "P{}0000{}".format(page_nb, index))
+        if page_nb == 3:
+            page = page.replace('class="a-last"', 'class="a-disabled"')
+        return page
+
+    checkpoint_path = str(tmp_path / "checkpoint.sqlite")
+    with ReplayServer(serve) as server:
+        search_url = server.url + "s?k=python"
+        runs = [amazonscraper.search(
+            search_url=search_url, max_product_nb=5,
+            checkpoint=amazonscraper.CrawlCheckpoint(checkpoint_path))
+            for _ in range(3)]
+
+    # 1st run : interrupted in the middle of the 2nd page
+    assert [p.asin for p in runs[0]] == \
+        ["1449355730", "1593279280", "B07K3FN5MR", "1492051365", "P200002"]
+    assert runs[0].stats['duplicates'] == 1
+    # 2nd run : resumed from the 2nd page, until the last one
+    assert [p.asin for p in runs[1]] == \
+        ["P200003", "P200004", "P300002", "P300003", "P300004"]
+    assert runs[1].stats['resumed_pages'] == 1
+    assert server.requests[2:4] == [
+        "/s?k=python&page=2&ref=sr_pg_2", "/s?k=python&page=3&ref=sr_pg_3"]
+    # 3rd run : all the pages again, without new products
+    assert len(runs[2]) == 0
+    assert len(server.requests) == 7
+
+
+def test_amazonscraper_memory_checkpoint_threads():
+    checkpoint = amazonscraper.CrawlCheckpoint(":memory:")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(checkpoint.save_page, "python",
+                        "https://www.amazon.com/s?k=python&page=2", 1,
+                        ["B01"]).result()
+
+    assert checkpoint.get("python").page_nb == 1
+    assert checkpoint.filter_seen("python", ["B01", "B02"]) == {"B01"}
+
+
+def test_amazonscraper_memory_crawl_queue_threads():
+    from amazonscraper.jobqueue import run_worker
+    page = load_page("search_result_mobile.html")
+    queue = amazonscraper.CrawlQueue(":memory:")
+    with ReplayServer(paginate(page)) as server:
+        queue.put(search_url=server.url + "s?k=python", max_product_nb=10)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(run_worker, queue,
+                                       owner="worker-{}".format(index),
+                                       poll_interval=0.01)
+                       for index in range(2)]
+            stats = [future.result() for future in futures]
+
+    assert queue.counts() == {"done": 3}
+    assert sum(worker_stats["jobs"] for worker_stats in stats) == 3
+    assert len(list(queue.results())) == 10
+
+
+def test_amazonscraper_crawl_queue(tmp_path):
+    from amazonscraper.jobqueue import run_worker
+    page = load_page("search_result_mobile.html")
+    queue_file = str(tmp_path / "queue.db")
+    queue = amazonscraper.CrawlQueue(queue_file, lease_time=60,
+                                     max_requests_per_host=1)
+    with ReplayServer(paginate(page), delay=0.05) as server:
+        for keywords in ["python", "scraping"]:
+            queue.put(search_url=server.url + "s?k=" + keywords,
+                      max_product_nb=10)
+        # a worker crashed with the first page leased
+        crashed_job = queue.lease("crashed-worker")
+        with queue._database.connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET lease_expires = 0 WHERE id = ?",
+                (crashed_job.id,))
+
+        # 2 workers, sharing the queue file
+        executor = ThreadPoolExecutor(max_workers=2)
+        futures = [executor.submit(
+            run_worker, amazonscraper.CrawlQueue(
+                queue_file, max_requests_per_host=1),
+            owner="worker-{}".format(index), poll_interval=0.01)
+            for index in range(2)]
+        stats = [future.result() for future in futures]
+        executor.shutdown()
+
+        # one page of the host at a time, over all the workers
+        assert server.max_in_flight == 1
+        assert len(server.requests) == 6
+
+    assert queue.is_finished()
+    assert queue.counts() == {"done": 6}
+    assert sum(worker_stats["jobs"] for worker_stats in stats) == 6
+    # the crashed worker can not record its page anymore
+    assert not queue.complete(crashed_job, [], None)
+    results = list(queue.results())
+    assert len(results) == 20
+    for search in [server.url + "s?k=python", server.url + "s?k=scraping"]:
+        assert [product["asin"] for result_search, product in results
+                if result_search == search] == \
+            [product.asin for product in amazonscraper.extract_products(
+                page)] * 2 + ["1449355730", "1593279280"]
+
+
+def test_amazonscraper_page_concurrency():
+    page = repeat_products(load_page("search_result_mobile.html"), 2)
+    with ReplayServer(paginate(page), delay=0.1) as server:
+        search_url = server.url + "s?k=python"
+        serial = amazonscraper.search(search_url=search_url,
+                                      max_product_nb=30)
+        server.requests.clear()
+        server.max_in_flight = 0
+        fanout = amazonscraper.search(search_url=search_url,
+                                      max_product_nb=30,
+                                      page_concurrency=4)
+
+    # the pages 2 to 4 are requested at the same time, with their number
+    assert server.requests[0] == "/s?k=python"
+    assert sorted(server.requests[1:]) == ["/s?k=python&page=2",
+                                           "/s?k=python&page=3",
+                                           "/s?k=python&page=4"]
+    assert server.max_in_flight == 3
+    # and their products are merged in the order of the pages
+    assert [repr(p.product) for p in fanout] == \
+        [repr(p.product) for p in serial]
+
+
+def test_amazonscraper_page_concurrency_from_page():
+    page = repeat_products(load_page("search_result_mobile.html"), 2)
+    with ReplayServer(paginate(page)) as server:
+        search_url = server.url + "s?k=python&page=3"
+        serial = amazonscraper.search(search_url=search_url,
+                                      max_product_nb=30)
+        serial_requests = list(server.requests)
+        server.requests.clear()
+        fanout = amazonscraper.search(search_url=search_url,
+                                      max_product_nb=30,
+                                      page_concurrency=4)
+
+    def page_nbs(paths):
+        return [parse_qs(urlsplit(path).query)['page'][0] for path in paths]
+
+    # the following pages are those of the search URL, not the pages 2...
+    assert page_nbs(serial_requests) == ["3", "4", "5", "6"]
+    assert page_nbs(server.requests[:1]) == ["3"]
+    assert sorted(page_nbs(server.requests[1:])) == ["4", "5", "6"]
+    assert [repr(p.product) for p in fanout] == \
+        [repr(p.product) for p in serial]
+
+
+def test_amazonscraper_page_concurrency_fallback():
+    page = load_page("search_result_mobile.html")
+    with ReplayServer(paginate(page)) as server:
+        products = amazonscraper.search(
+            search_url=server.url + "s/ref=nb_sb_noss?field-keywords=python",
+            max_product_nb=_MAX_PRODUCT_NB,
+            page_concurrency=4)
+
+    # unknown URL shape : the next page links are followed
+    assert products.stats['fanout_fallbacks'] == 1
+    assert len(products) == _MAX_PRODUCT_NB
+    assert len(server.requests) == 3
+
+
+def test_amazonscraper_non_us_domain():
+    amz = amazonscraper.Client()
+    amz._update_headers("https://www.amazon.fr/s?k=python")
+    amz._extract_page(load_page("search_result_mobile_fr.html"),
+                      max_product_nb=_MAX_PRODUCT_NB)
+
+    # "39,99 €", "4,5 sur 5 étoiles", "1 102" (with non-breaking spaces)
+    product = amz.product_dict_list[0]
+    assert product['prices_main'] == 39.99
+    assert product['rating'] == 4.5
+    assert product['review_nb'] == 1102
+    assert product['url'].startswith("https://www.amazon.fr/")
+    product = amz.product_dict_list[2]
+    assert product['prices_per_unit'] == 0.5
+    assert product['units'] == "unité"
+    # 2 formats ("49,99 €" and "1 234,56 €") : the first price is kept
+    assert amz.product_dict_list[3]['prices_main'] == 49.99
+    assert amz.stats['multiple_prices'] == 1
+
+
+def test_amazonscraper_amounts_not_prices():
+    page = load_page("search_result_mobile.html")
+    # an amount without cents in a sentence, and a rating matched by the
+    # selector of the number of reviews
+    page = page.replace(
+        '<span class="a-offscreen">$39.99</span></span></div>',
+        '<span class="a-offscreen">$39.99</span></span></div>'
+        '<div class="a-row"><span>FREE Shipping on orders over $25 shipped '
+        'by Amazon</span></div>', 1)
+    page = page.replace('<span class="a-size-base">1,102</span>',
+                        '<span class="a-size-base">4.5</span>', 1)
+    amz = amazonscraper.Client()
+    amz._update_headers("https://www.amazon.com/s?k=python")
+    amz._extract_page(page, max_product_nb=_MAX_PRODUCT_NB)
+
+    product = amz.product_dict_list[0]
+    assert product['prices_main'] == 39.99
+    assert math.isnan(product['review_nb'])
+    assert amz.stats['multiple_prices'] == 0
+
+
+def test_amazonscraper_enrich():
+    result_page = load_page("search_result_mobile.html")
+    detail_page = load_page("product_detail.html")
+
+    def serve(path):
+        return detail_page if path.startswith("/dp/") else result_page
+
+    amz = amazonscraper.Client()
+    with ReplayServer(serve, delay=0.1) as server:
+        search_url = server.url + "s?k=python"
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=4, enrich=True,
+                                        client=amz)
+        # the 4 detail pages are downloaded concurrently
+        assert sorted(server.requests[1:]) == sorted(
+            "/dp/" + product.asin for product in products)
+        assert server.max_in_flight == 4
+
+        # the details of the same products are not downloaded again
+        products = amazonscraper.search(search_url=search_url,
+                                        max_product_nb=2, enrich=True,
+                                        client=amz)
+        assert len(server.requests) == 6
+        assert products.stats['detail_cache_hits'] == 2
+
+    product = products[0]
+    assert product.brand == "O'Reilly Media"
+    assert product.availability == "In Stock"
+    assert product.price == 39.99
+    assert product.list_price == 64.99
+    assert product.category == \
+        "Books > Computers & Technology > Programming Languages"